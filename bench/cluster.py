@@ -0,0 +1,61 @@
+# Local test of a cluster: game server nodes and the router (src/router.py) as separate processes on this machine,
+# with the bots of bench/load.py connected to the router
+# Usage: python bench/cluster.py [nodes] [clients] [seconds]
+# CLUSTER_DRAIN_AT=<seconds> drains the first node at that time of the run. With the in-memory broker every process
+# has its own, so chat messages cannot cross processes and chat is off unless RABBITMQ_HOST is a real broker
+import asyncio
+import os
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+src = os.path.join(root, "src")
+sys.path.append(src)
+sys.path.append(os.path.join(root, "protos"))
+
+os.environ.setdefault("RABBITMQ_HOST", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+if os.environ["RABBITMQ_HOST"] == "memory":
+    os.environ["LOAD_CHAT_RATE"] = "0"
+
+import logs
+from loadgen import LoadGenerator
+from router import drain
+from load import report, THINK_TIME, CHAT_RATE, DISCONNECT_RATE
+
+BASE_PORT = int(os.environ.get("CLUSTER_PORT", 51080))
+DRAIN_AT = os.environ.get("CLUSTER_DRAIN_AT")
+
+
+def start(script, **env):
+    return subprocess.Popen([sys.executable, script], cwd=src, env=dict(os.environ, **env))
+
+
+async def run(load, duration, router_address, drained):
+    if DRAIN_AT is not None:
+        async def drain_later():
+            await asyncio.sleep(float(DRAIN_AT))
+            await drain(router_address, drained)
+        load.spawn(drain_later())
+    await load.run(duration)
+
+
+if __name__ == "__main__":
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 60
+    logs.setup()
+
+    addresses = [f"127.0.0.1:{BASE_PORT + 1 + index}" for index in range(nodes)]
+    router_address = f"127.0.0.1:{BASE_PORT}"
+    processes = [start("server.py", SERVER_PORT=str(BASE_PORT + 1 + index), NODE_NAME=f"node{index}") for index in range(nodes)]
+    processes.append(start("router.py", ROUTER_PORT=str(BASE_PORT), ROUTER_NODES=",".join(addresses)))
+    try:
+        load = LoadGenerator(router_address, clients, THINK_TIME, CHAT_RATE, DISCONNECT_RATE)
+        asyncio.run(run(load, duration, router_address, addresses[0]))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    report(load, clients, duration)
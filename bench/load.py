@@ -0,0 +1,54 @@
+# Load test of the game server: thousands of bot clients from one process (src/loadgen.py)
+# Usage: python bench/load.py [clients] [seconds]
+# Without SERVER_ADDRESS the threaded server is started in this process with the in-memory broker
+# (unless RABBITMQ_HOST is set), otherwise the bots connect to the running server and RabbitMQ
+import asyncio
+import os
+import sys
+import threading
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root, "src"))
+sys.path.append(os.path.join(root, "protos"))
+
+server_address = os.environ.get("SERVER_ADDRESS")
+if server_address is None:
+    os.environ.setdefault("RABBITMQ_HOST", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING") # LOG_LEVEL=INFO measures the cost of logging as well
+
+import logs
+from loadgen import LoadGenerator
+
+THINK_TIME = float(os.environ.get("LOAD_THINK_TIME", 0.5))
+CHAT_RATE = float(os.environ.get("LOAD_CHAT_RATE", 0.05))
+DISCONNECT_RATE = float(os.environ.get("LOAD_DISCONNECT_RATE", 0))
+
+
+def milliseconds(seconds):
+    return f"{seconds * 1e3:.1f}" if seconds is not None else "-"
+
+
+def report(load, clients, duration):
+    print(f"{clients} clients for {duration:.0f} s")
+    for name, value in load.counters.items():
+        print(f"{name:>24}{value:>10}{value / duration:>10.1f}/s")
+    print(f"{'':>24}{'count':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind in load.latencies.samples:
+        print(f"{kind:>24}{load.latencies.count(kind):>10}{milliseconds(load.latencies.percentile(kind, 0.5)):>10}"
+              f"{milliseconds(load.latencies.percentile(kind, 0.99)):>10}{milliseconds(load.latencies.percentile(kind, 1)):>10}")
+
+
+if __name__ == "__main__":
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    logs.setup()
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+    if server_address is None:
+        os.environ.setdefault("STREAM_WORKERS", str(clients)) # The threaded server needs a thread per Events stream
+        import server
+        server_address = "127.0.0.1:" + os.environ.get("SERVER_PORT", "51075")
+        threading.Thread(target=server.serve, args=(server_address, None), daemon=True).start()
+
+    load = LoadGenerator(server_address, clients, THINK_TIME, CHAT_RATE, DISCONNECT_RATE)
+    asyncio.run(load.run(duration))
+    report(load, clients, duration)
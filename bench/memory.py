@@ -0,0 +1,80 @@
+# Memory taken by GameState objects at different stages of a game, compared with the old representation
+# (src/mafia.py as it was before players became indices and bitsets, read from git)
+# Usage: python bench/memory.py [games per stage]
+# MEMORY_BASELINE=<commit> compares with src/mafia.py of another commit
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+import types
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root, "src"))
+
+from mafia import GameState
+
+BASELINE = os.environ.get("MEMORY_BASELINE", "eb1b9aa") # The commit before the compact GameState
+
+
+def idle(game, players):
+    pass
+
+
+def waiting(game, players):
+    for name in players:
+        game.add_player(name)
+
+
+def started(game, players):
+    waiting(game, players)
+    game.start_game()
+    while game.take_notification() is not None:
+        pass
+    while game.take_await_actions() is not None:
+        pass
+
+
+def voting(game, players):
+    # Everyone has an open vote in the middle of a day
+    started(game, players)
+    for name in players:
+        options = game.actions(name)
+        game.perform_action(name, random.choice([option for option in options if len(option) == 1] if len(options) == 1 else options[1:]))
+    while game.take_await_actions() is not None:
+        pass
+
+
+def load_baseline(revision):
+    # src/mafia.py of the commit as a module that is not kept anywhere
+    source = subprocess.run(["git", "show", f"{revision}:src/mafia.py"], cwd=root, capture_output=True, text=True, check=True).stdout
+    module = types.ModuleType("baseline_mafia")
+    exec(compile(source, f"{revision}:src/mafia.py", "exec"), module.__dict__)
+    return module
+
+
+def measure(stage, games, players, game_class=GameState):
+    names = [f"Player{index}" for index in range(players)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = []
+    for _ in range(games):
+        game = game_class()
+        stage(game, names)
+        kept.append(game)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / games
+
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    baseline_mafia = load_baseline(BASELINE)
+    print(f"{'stage':<10}{'players':>8}{'baseline bytes':>16}{'bytes per game':>16}{'ratio':>8}")
+    for stage in (idle, waiting, started, voting):
+        for players in (4, 5, 6) if stage is not idle else (0,):
+            random.seed(0)
+            baseline = measure(stage, games, players, baseline_mafia.GameState)
+            random.seed(0)
+            current = measure(stage, games, players)
+            print(f"{stage.__name__:<10}{players:>8}{baseline:>16.0f}{current:>16.0f}{baseline / current:>8.1f}")
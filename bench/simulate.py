@@ -0,0 +1,26 @@
+# Headless benchmark of the game logic: random bots play whole games in-process, no grpc or RabbitMQ needed
+# Usage: python bench/simulate.py [games per player count] [games in progress at once]
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from config import roles_config
+from simulator import simulate
+from memory import measure, started
+
+
+def microseconds(seconds):
+    return f"{seconds * 1e6:.1f}" if seconds is not None else "-"
+
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrent = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print(f"{'players':>7}{'games/s':>10}{'transitions/s':>15}{'actions/s':>11}{'p50 us':>9}{'p99 us':>9}{'bytes/game':>12}")
+    for players in sorted(roles_config.keys()):
+        result = simulate(games, players, concurrent, seed=players)
+        memory = measure(started, min(games, 2000), players)
+        print(f"{players:>7}{result.games_per_second():>10.0f}{result.transitions_per_second():>15.0f}"
+              f"{result.actions / result.elapsed:>11.0f}{microseconds(result.percentile(0.5)):>9}"
+              f"{microseconds(result.percentile(0.99)):>9}{memory:>12.0f}")
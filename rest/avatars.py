@@ -0,0 +1,69 @@
+import logging
+import os
+import uuid
+
+from PIL import Image
+
+IMAGES_DIR = "rest/images"
+THUMBS_DIR = "rest/images/thumbs" # Small copies of the avatars, the only ones reports ever decode
+THUMB_SIZE = (180, 180) # Twice the size the avatar is drawn at in a report
+MAX_AVATAR_SIZE = int(os.getenv("MAX_AVATAR_SIZE", 5 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+
+class AvatarTooLarge(Exception):
+    pass
+
+
+def thumb_path(avatar):
+    return f"{THUMBS_DIR}/{avatar}"
+
+
+def make_thumbnail(path, thumb):
+    tmp_path = f"{thumb}.{uuid.uuid4().hex}.tmp"
+    with Image.open(path) as image:
+        image.convert("RGBA").resize(THUMB_SIZE).save(tmp_path, format="PNG")
+    os.replace(tmp_path, thumb)
+
+
+def ensure_thumbnails():
+    # Thumbnails for the avatars that were uploaded before thumbnails existed (and for default.png).
+    # Also removes the temporary files of uploads that were killed halfway
+    os.makedirs(THUMBS_DIR, exist_ok=True)
+    for directory in (THUMBS_DIR, IMAGES_DIR):
+        for file in os.listdir(directory):
+            if file.endswith(".tmp"):
+                os.remove(f"{directory}/{file}")
+
+    for file in os.listdir(IMAGES_DIR):
+        path = f"{IMAGES_DIR}/{file}"
+        if os.path.isfile(path) and not os.path.exists(thumb_path(file)):
+            try:
+                make_thumbnail(path, thumb_path(file))
+            except (OSError, ValueError, Image.DecompressionBombError) as error:
+                logging.info("Failed to make a thumbnail for %s: %s", path, error)
+
+
+def save_avatar(name, stream):
+    # Streams the upload to disk in chunks (never more than CHUNK_SIZE in memory), then creates the thumbnail.
+    # Both files are written under temporary names and renamed, so readers never see a partial image.
+    # Returns the avatar file name
+    avatar = f"{name}.png"
+    tmp_path = f"{IMAGES_DIR}/{avatar}.{uuid.uuid4().hex}.tmp"
+    size = 0
+    try:
+        with open(tmp_path, "wb") as file:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_AVATAR_SIZE:
+                    raise AvatarTooLarge
+                file.write(chunk)
+        make_thumbnail(tmp_path, thumb_path(avatar))
+        os.replace(tmp_path, f"{IMAGES_DIR}/{avatar}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return avatar
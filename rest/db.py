@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import threading
+from queue import Queue, Empty
+
+DB_NAME = "rest/profiles.db"
+GROUP_COMMIT_SIZE = 256 # Most write jobs committed in one transaction
+STATEMENT_CACHE = 128 # Prepared statements kept per connection
+READ_CONNECTIONS = int(os.getenv("DB_READ_CONNECTIONS", 8))
+
+# Reads take a connection from a fixed pool, all writes go through a single writer thread that commits
+# whatever has queued up in one transaction (group commit). With WAL readers never wait for the writer,
+# and synchronous=NORMAL only syncs at checkpoints instead of on every commit
+
+writer = None
+
+
+def connect(check_same_thread=True):
+    conn = sqlite3.connect(DB_NAME, isolation_level=None, check_same_thread=check_same_thread, cached_statements=STATEMENT_CACHE)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class ReadPool:
+    # Flask runs every request on a new thread, so connections are shared between threads: a reader takes one
+    # for a query and gives it back. At most `size` connections are ever opened, more readers wait for one
+    def __init__(self, size):
+        self.size = size
+        self.idle = Queue()
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def take(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                conn = connect(check_same_thread=False)
+                self.opened += 1
+                return conn
+        return self.idle.get()
+
+    def give_back(self, conn):
+        self.idle.put(conn)
+
+
+readers = ReadPool(READ_CONNECTIONS)
+
+
+class WriteJob:
+    def __init__(self, statements):
+        self.statements = statements # List of (sql, list of parameter tuples)
+        self.done = threading.Event()
+        self.error = None
+
+
+class Writer:
+    def __init__(self):
+        self.jobs = Queue()
+        threading.Thread(target=self.run, daemon=True, name="db-writer").start()
+
+    def write(self, statements):
+        # Blocks until the statements are committed
+        job = WriteJob(statements)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+
+    def run(self):
+        conn = connect()
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < GROUP_COMMIT_SIZE:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except Empty:
+                    break
+
+            conn.execute("BEGIN")
+            for job in batch:
+                # A failing job is rolled back alone, the rest of the group is still committed
+                conn.execute("SAVEPOINT job")
+                try:
+                    for sql, parameters in job.statements:
+                        conn.executemany(sql, parameters)
+                    conn.execute("RELEASE job")
+                except sqlite3.Error as error:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    job.error = error
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.Error as error:
+                conn.execute("ROLLBACK")
+                for job in batch:
+                    job.error = job.error or error
+
+            for job in batch:
+                job.done.set()
+
+
+def init_db():
+    global writer
+    conn = connect()
+    conn.execute("PRAGMA journal_mode=WAL") # Stored in the database file, so only set once
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, age INTEGER, email TEXT, avatar_img TEXT, played INTEGER, wins INTEGER, ingame FLOAT, version INTEGER DEFAULT 0)''')
+    # Databases created before the version column existed
+    if "version" not in [column[1] for column in conn.execute("PRAGMA table_info(users)")]:
+        conn.execute("ALTER TABLE users ADD COLUMN version INTEGER DEFAULT 0")
+    conn.close()
+    writer = Writer()
+
+
+def insert_sql(columns):
+    return f"INSERT INTO users ({', '.join(['name'] + list(columns))}) VALUES (?{', ?' * len(columns)}) ON CONFLICT(name) DO NOTHING"
+
+
+# Every update bumps the row version, which is what cached reports are keyed by
+
+def set_sql(columns):
+    return f"UPDATE users SET {', '.join([f'{column} = ?' for column in columns] + ['version = version + 1'])} WHERE name = ?"
+
+
+def add_sql(columns):
+    return f"UPDATE users SET {', '.join([f'{column} = {column} + ?' for column in columns] + ['version = version + 1'])} WHERE name = ?"
+
+
+def add_entry(name, **columns):
+    writer.write([(insert_sql(columns.keys()), [[name] + list(columns.values())])])
+
+
+def update_set_entry(name, **columns):
+    writer.write([(set_sql(columns.keys()), [list(columns.values()) + [name]])])
+
+
+def update_add_entry(name, **columns):
+    writer.write([(add_sql(columns.keys()), [list(columns.values()) + [name]])])
+
+
+def bulk_update(create, add):
+    # create: name -> columns for new users, add: name -> increments. Rows with the same columns
+    # share one statement, and everything is committed together
+    statements = dict()
+    for name, columns in create.items():
+        statements.setdefault(insert_sql(columns.keys()), []).append([name] + list(columns.values()))
+    for name, columns in add.items():
+        statements.setdefault(add_sql(columns.keys()), []).append(list(columns.values()) + [name])
+    # Inserts go first so that increments for just created users are not lost
+    writer.write(sorted(statements.items(), key=lambda statement: not statement[0].startswith("INSERT")))
+
+
+def delete_entry(name):
+    writer.write([("DELETE FROM users WHERE name = ?", [(name,)])])
+
+
+def lookup(name):
+    conn = readers.take()
+    try:
+        return conn.execute("SELECT * FROM users WHERE name = ?", (name,)).fetchone()
+    finally:
+        readers.give_back(conn)
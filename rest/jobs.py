@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+import uuid
+
+REPORT_TTL = int(os.getenv("REPORT_TTL", 3600)) # Seconds a finished report and its file are kept
+
+
+class Job:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = "queued" # queued -> rendering -> done / failed
+        self.future = None # Render in progress, if any
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def status(self):
+        state = self.state
+        if state == "queued" and self.future is not None and self.future.running():
+            state = "rendering"
+        return {"id": self.id, "name": self.name, "state": state}
+
+
+class JobRegistry:
+    # Keeps the state of every report job so that clients can ask for it or wait for it instead of
+    # polling for the file. Finished jobs and their files are removed after REPORT_TTL seconds
+    def __init__(self, reports_dir, ttl=REPORT_TTL):
+        self.reports_dir = reports_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        threading.Thread(target=self.run_cleanup, daemon=True, name="report-cleanup").start()
+
+    def create(self, name):
+        job = Job(name)
+        with self.lock:
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def finish(self, job, error):
+        job.state = "done" if error is None else "failed"
+        job.finished = time.time()
+        job.future = None
+        job.done.set()
+
+    def wait(self, job_id, timeout):
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def cleanup(self):
+        now = time.time()
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished is not None and job.finished + self.ttl < now]
+            for job in expired:
+                self.jobs.pop(job.id)
+        for job in expired:
+            try:
+                os.remove(f"{self.reports_dir}/{job.id}.pdf")
+            except FileNotFoundError:
+                pass
+
+        # Files left over from earlier runs
+        for file in os.listdir(self.reports_dir):
+            path = os.path.join(self.reports_dir, file)
+            if file.endswith(".pdf") and file[:-len(".pdf")] not in self.jobs and os.stat(path).st_mtime + self.ttl < now:
+                os.remove(path)
+
+    def run_cleanup(self):
+        while True:
+            time.sleep(max(1, self.ttl // 10))
+            self.cleanup()
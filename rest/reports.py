@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import shutil
+import threading
+import time
+
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen.canvas import Canvas
+
+from db import lookup
+from avatars import thumb_path
+from jobs import REPORT_TTL
+
+REPORTS_DIR = "rest/reports"
+CACHE_DIR = "rest/report_cache" # Rendered reports, one file per (user, row version). Not served: only reports/<id>.pdf are
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", os.cpu_count() or 1))
+
+avatars = dict() # Per worker process: thumbnail path -> (mtime, decoded ImageReader)
+
+
+def avatar(path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = avatars.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, ImageReader(path))
+        avatars[path] = cached
+    return cached[1]
+
+
+def render(data, path):
+    # Runs in a worker process, writes the pdf next to path and moves it in place when it is complete
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    canvas = Canvas(tmp_path, pagesize=(350, 110))
+    canvas.drawString(12, 90, f"Name: {data[0]}")
+    canvas.drawString(12, 75, f"Age: {data[1] if data[1] is not None else 'Not set'}")
+    canvas.drawString(12, 60, f"Email: {data[2] if data[2] is not None else 'Not set'}")
+    canvas.drawString(12, 45, f"Games played: {data[4] if data[4] is not None else 'Not set'}")
+    canvas.drawString(12, 30, f"Wins: {data[5] if data[5] is not None else 'Not set'}")
+    canvas.drawString(12, 15, f"Time spent playing: {round(data[6], 3) if data[6] is not None else 'Not set'} seconds")
+
+    canvas.drawImage(avatar(thumb_path(data[3])), x=250, y=10, width=90, height=90)
+    canvas.save()
+    os.replace(tmp_path, path)
+
+
+def render_missing(name, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    canvas = Canvas(tmp_path, pagesize=(300, 50))
+    canvas.drawString(12, 25, f"Profile with name {name} was not found...")
+    canvas.save()
+    os.replace(tmp_path, path)
+
+
+def publish(source, path):
+    # Gives the task its own name for an already rendered file without copying it when possible
+    try:
+        os.link(source, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+class ReportEngine:
+    # Renders reports in a pool of processes. A report is cached by the user's row version, so an unchanged
+    # profile is never rendered twice, and concurrent requests for the same version share one render.
+    # Cached files unused for cache_ttl seconds are removed. The lock is held while a cached file is checked
+    # and published and while the cache is cleaned, so a file is never removed between the two. A fresh render
+    # removed before it was published is rendered again
+    def __init__(self, workers=REPORT_WORKERS, cache_ttl=REPORT_TTL):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.rendering = dict() # cache path -> future of the render
+        self.cache_ttl = cache_ttl
+        threading.Thread(target=self.run_cleanup, daemon=True, name="report-cache-cleanup").start()
+
+    def submit(self, task_id, name, on_done=None):
+        # Calls on_done(error) once rest/reports/<task_id>.pdf is in place (error is None on success),
+        # returns the future of the render or None if the report was already cached
+        path = f"{REPORTS_DIR}/{task_id}.pdf"
+        data = lookup(name)
+        if data is None:
+            future = self.pool.submit(render_missing, name, path)
+            future.add_done_callback(lambda future: self.finish(future, None, path, on_done))
+            return future
+
+        cached = f"{CACHE_DIR}/{name}-{data[7]}.pdf"
+        error = None
+        started = False
+        with self.lock:
+            future = self.rendering.get(cached)
+            if future is None and os.path.exists(cached):
+                try:
+                    publish(cached, path)
+                    os.utime(cached) # Last use, for the cleanup
+                except OSError as publish_error:
+                    error = publish_error
+            elif future is None:
+                future = self.pool.submit(render, data, cached)
+                self.rendering[cached] = future
+                started = True
+
+        if started:
+            future.add_done_callback(lambda future: self.forget(cached)) # Not under the lock, it may run right away
+        if future is None:
+            self.report(error, path, on_done)
+        else:
+            future.add_done_callback(lambda future: self.finish(future, cached, path, on_done, lambda: self.submit(task_id, name, on_done)))
+        return future
+
+    def forget(self, cached):
+        with self.lock:
+            self.rendering.pop(cached, None)
+
+    def finish(self, future, cached, path, on_done, again=None):
+        error = future.exception()
+        if error is None and cached is not None:
+            try:
+                with self.lock:
+                    publish(cached, path)
+            except FileNotFoundError as publish_error:
+                if again is not None:
+                    again() # Removed by the cleanup before it was published, rendered once more
+                    return
+                error = publish_error
+            except OSError as publish_error:
+                error = publish_error
+        self.report(error, path, on_done)
+
+    def report(self, error, path, on_done):
+        if error is not None:
+            logging.info("Failed to render report %s: %s", path, error)
+        if on_done is not None:
+            on_done(error)
+
+    def cleanup(self):
+        now = time.time()
+        with self.lock:
+            for file in os.listdir(CACHE_DIR):
+                path = f"{CACHE_DIR}/{file}"
+                rendered = path[:path.index(".pdf") + len(".pdf")] if ".pdf" in path else path # Temporary files have a suffix
+                if rendered not in self.rendering and os.stat(path).st_mtime + self.cache_ttl < now:
+                    os.remove(path)
+
+    def run_cleanup(self):
+        while True:
+            time.sleep(max(1, self.cache_ttl // 10))
+            self.cleanup()
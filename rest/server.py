@@ -1,111 +1,27 @@
-import sqlite3
 from flask import Flask, abort, request
 import flask
-from queue import Queue
-import threading
-from reportlab.pdfgen.canvas import Canvas
-import random
 import logging
 import os
 
-DB_NAME = "rest/profiles.db"
+from PIL import Image
+
+from db import init_db, add_entry, update_set_entry, update_add_entry, bulk_update, lookup
+from reports import ReportEngine, REPORTS_DIR
+from jobs import JobRegistry
+from avatars import save_avatar, ensure_thumbnails, thumb_path, AvatarTooLarge, MAX_AVATAR_SIZE
+
 PORT = os.getenv("PORT", 15430)
 
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, age INTEGER, email TEXT, avatar_img TEXT, played INTEGER, wins INTEGER, ingame FLOAT)''')
-
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def add_entry(name, **columns):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"INSERT INTO users\
-                   ({', '.join(['name'] + list(columns.keys()))}) SELECT ?{', ?' * len(columns)}\
-                    WHERE NOT EXISTS (SELECT 1 FROM users WHERE name = ?)",\
-                    [name] + list(columns.values()) + [name])
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def update_set_entry(name, **columns):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"UPDATE users SET\
-                   { ', '.join([f'{column} = ?' for column in columns.keys()]) }\
-                   WHERE name = ?", 
-                    list(columns.values()) + [name])
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def update_add_entry(name, **columns):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(f"UPDATE users SET\
-                   { ', '.join([f'{column} = {column} + ?' for column in columns.keys()]) }\
-                   WHERE name = ?", 
-                    list(columns.values()) + [name])
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def delete_entry(name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE name = ?", (name,))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def lookup(name):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE name = ?", (name,))
-    res = cursor.fetchone()
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return res
-
-
-queue = Queue()
-
-
-def worker_pdf(queue_in):
-    while True:
-        task_id, name = queue_in.get()
-        data = lookup(name)
-        if data is None:
-            canvas = Canvas(f"rest/reports/{task_id}.pdf", pagesize=(300, 50))
-            canvas.drawString(12, 25, f"Profile with name {name} was not found...")
-            canvas.save()
-        else:
-            canvas = Canvas(f"rest/reports/{task_id}.pdf", pagesize=(350, 110))
-            canvas.drawString(12, 90, f"Name: {data[0]}")
-            canvas.drawString(12, 75, f"Age: {data[1] if data[1] is not None else 'Not set'}")
-            canvas.drawString(12, 60, f"Email: {data[2] if data[2] is not None else 'Not set'}")
-            canvas.drawString(12, 45, f"Games played: {data[4] if data[4] is not None else 'Not set'}")
-            canvas.drawString(12, 30, f"Wins: {data[5] if data[5] is not None else 'Not set'}")
-            canvas.drawString(12, 15, f"Time spent playing: {round(data[6], 3) if data[6] is not None else 'Not set'} seconds")
-
-            canvas.drawImage(f"rest/images/{data[3]}", x=250, y=10, width=90, height=90)
-            canvas.save()
+engine = None
+jobs = None
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_AVATAR_SIZE + 64 * 1024 # Room for the multipart headers
 
 @app.route("/users/<string:name>", methods=["POST"])
 def add_user(name):
-    logging.info(f"INSERT {name}")
+    logging.info("INSERT %s", name)
     info = request.get_json()
 
     try:
@@ -133,24 +49,76 @@ def update_user_add(name):
         abort(400)
     return "Done\n"
 
+@app.route("/users/bulk", methods=["POST"])
+def bulk_users():
+    # {"create": {name: {"email": ..., "age": ...}}, "add": {name: {"played": ..., "wins": ..., "ingame": ...}}}
+    info = request.get_json()
+    create = {name: dict(avatar_img="default.png", played=0, wins=0, ingame=0, age=columns.get("age"), email=columns.get("email"))
+              for name, columns in info.get("create", {}).items()}
+    add = {name: {column: columns[column] for column in ("ingame", "played", "wins") if column in columns}
+           for name, columns in info.get("add", {}).items()}
+    try:
+        bulk_update(create, {name: columns for name, columns in add.items() if columns})
+    except:
+        abort(400)
+    return "Done\n"
+
 @app.route("/users/avatar/<string:name>", methods=["POST"])
 def update_image(name):
-    img = request.files.get("avatar")
+    # Either a multipart form with an "avatar" file (curl -F avatar=@picture.png) or the raw image as the body
+    # (curl --data-binary @picture.png -H "Content-Type: image/png")
+    if request.mimetype == "multipart/form-data":
+        img = request.files.get("avatar")
+        stream = img.stream if img is not None else None
+    else:
+        stream = request.stream if request.content_length else None
+
     avatar = "default.png"
-    if img is not None:
-        img.save(f"rest/images/{name}.png")
-        avatar = f"{name}.png"
+    if stream is not None:
+        try:
+            avatar = save_avatar(name, stream)
+        except AvatarTooLarge:
+            abort(413)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            abort(400)
     try:
         update_set_entry(name, avatar_img=avatar)
     except:
         abort(400)
     return "Done\n"
 
+@app.route("/users/avatar/<string:name>", methods=["GET"])
+def give_avatar(name):
+    data = lookup(name)
+    if data is None:
+        abort(404)
+    # send_file hands the open file to the wsgi server, which can send it with sendfile
+    return flask.send_file(os.path.abspath(thumb_path(data[3])), mimetype="image/png")
+
 @app.route("/reports/<string:name>", methods=["POST"])
 def post_task(name):
-    id = random.randint(1000000, 9999999)
-    queue.put((id, name))
-    return f"It will be available by the link http://127.0.0.1:{PORT}/reports/{id}.pdf\n"
+    job = jobs.create(name)
+    job.future = engine.submit(job.id, name, lambda error: jobs.finish(job, error))
+    return f"It will be available by the link http://127.0.0.1:{PORT}/reports/{job.id}.pdf\n" \
+           f"Status: http://127.0.0.1:{PORT}/reports/status/{job.id}, wait for it: http://127.0.0.1:{PORT}/reports/wait/{job.id}\n"
+
+
+@app.route("/reports/status/<string:job_id>", methods=["GET"])
+def report_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return job.status()
+
+
+@app.route("/reports/wait/<string:job_id>", methods=["GET"])
+def wait_report(job_id):
+    # Long poll: answers as soon as the report is done or failed, or after ?timeout= seconds (at most 60)
+    timeout = min(request.args.get("timeout", 30, type=float), 60)
+    job = jobs.wait(job_id, timeout)
+    if job is None:
+        abort(404)
+    return job.status()
 
 
 @app.route("/reports/<path:path>", methods=["GET"])
@@ -167,7 +135,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     logging.info("Starting")
     init_db()
-    worker_thread = threading.Thread(target=worker_pdf, args=[queue])
-    worker_thread.start()
-    app.run(host="0.0.0.0", port=PORT)
-    worker_thread.join()
\ No newline at end of file
+    ensure_thumbnails()
+    engine = ReportEngine()
+    jobs = JobRegistry(REPORTS_DIR)
+    app.run(host="0.0.0.0", port=PORT)
\ No newline at end of file
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+
+import grpc
+import aio_pika
+
+import server_pb2_grpc, messages_pb2
+
+import metrics
+from events import ClientEvents
+from chat import RABBITMQ_HOST, CHAT_EXCHANGE, RECONNECT_DELAY
+from sessions import Sessions, PING_INTERVAL, PING_SLICES
+
+# The same game server as in server.py, but with an asyncio transport: grpc.aio for the servicer and the Events
+# streams and aio_pika for the chat. Everything runs on one thread, the game logic is shared with server.py
+# (sessions.Sessions)
+
+logger = logging.getLogger("SERVER")
+
+
+class AioStreamClient(ClientEvents):
+    # Events of one client for a stream served on the event loop
+    def __init__(self, address, name):
+        ClientEvents.__init__(self, address, name)
+        self.wakeup = asyncio.Event()
+
+    def changed(self):
+        self.wakeup.set()
+
+    async def batches(self, stream):
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                if not self.is_current(stream):
+                    return
+                batch = self.take_batch() if self.has_news() else None
+            if batch is None:
+                await self.wakeup.wait()
+            else:
+                yield batch
+
+
+class AioServer(Sessions, server_pb2_grpc.ServerServicer):
+    def __init__(self, db_server):
+        Sessions.__init__(self, db_server)
+        self.wakeup = asyncio.Event()
+        self.exchange = None
+        self.tasks = set() # The event loop only keeps weak references to tasks
+
+    def spawn(self, awaitable):
+        task = asyncio.ensure_future(awaitable)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def make_client(self, address, name):
+        return AioStreamClient(address, name)
+
+    def wake(self):
+        self.wakeup.set()
+
+    def call_later(self, delay, callback):
+        asyncio.get_running_loop().call_later(delay, callback)
+
+    async def Register(self, request, context):
+        return self.register(request)
+
+    async def Leave(self, request, context):
+        self.leave(request.address)
+        return messages_pb2.LeaveResult()
+
+    async def TakeAction(self, request, context):
+        return self.take_action(request)
+
+    async def Events(self, request, context):
+        user = self.connected(request.address)
+        if user is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "Not registered")
+        async for batch in user.batches(user.attach(request.last_seq)):
+            yield batch
+
+    async def Ack(self, request, context):
+        return self.ack(request)
+
+    async def Drain(self, request, context):
+        return self.drain()
+
+    async def Status(self, request, context):
+        return self.status()
+
+    async def run_dispatch(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            self.dispatch()
+
+    async def run_heartbeat(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL / PING_SLICES)
+            self.heartbeat.tick()
+
+    async def consume(self):
+        connection = None
+        while connection is None:
+            try:
+                connection = await aio_pika.connect_robust(host=RABBITMQ_HOST)
+            except (aio_pika.exceptions.AMQPError, OSError):
+                logger.info("Waiting for rabbitmq server...")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+        channel = await connection.channel()
+        self.exchange = await channel.declare_exchange(CHAT_EXCHANGE, aio_pika.ExchangeType.DIRECT)
+        queue = await channel.declare_queue(self.chat_queue)
+        async with queue.iterator() as messages:
+            async for message in messages:
+                await message.ack()
+                try:
+                    self.client_message(message.headers.get("address"), message.body)
+                except Exception:
+                    logger.exception("Failed to handle a message from %s", self.chat_queue)
+
+    def publish(self, addresses, text):
+        # One publish delivered to every address (RabbitMQ sender-selected distribution)
+        if not addresses or self.exchange is None:
+            return
+        headers = {"CC": addresses[1:]} if len(addresses) > 1 else None
+        self.spawn(self.exchange.publish(aio_pika.Message(body=text.encode(), headers=headers), routing_key=addresses[0]))
+
+
+async def run(address, db_server):
+    server_instance = AioServer(db_server)
+    server_instance.recover()
+    metrics.serve()
+
+    server = grpc.aio.server()
+    server_pb2_grpc.add_ServerServicer_to_server(server_instance, server)
+    server.add_insecure_port(address)
+    await server.start()
+    logger.info("Started asyncio server at address %s", address)
+
+    await asyncio.gather(server_instance.run_dispatch(), server_instance.run_heartbeat(),
+                         server_instance.consume(), server.wait_for_termination())
+
+
+def serve(address, db_server):
+    asyncio.run(run(address, db_server))
@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import time
+from queue import Queue, Empty
+
+import pika
+
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "rabbitMQService")
+CHAT_EXCHANGE = "chat" # Direct exchange, every client queue is bound to it by its address
+SERVER_QUEUE = "server_in" # Shared queue for messages from all clients, the sender is in the "address" header
+RECONNECT_DELAY = 3
+BATCH_SIZE = 256
+FLUSH_PERIOD = 5 # Lets pika answer broker heartbeats while there is nothing to publish
+MEMORY_HOST = "memory" # RABBITMQ_HOST value for an in-process stand-in of the broker, for load tests in one process
+
+logger = logging.getLogger("CHAT")
+
+
+def server_queue(node=None):
+    # The queue a server consumes client messages from, every node of a cluster (see router.py) has its own
+    return SERVER_QUEUE + "." + node if node else SERVER_QUEUE
+
+
+class MemoryBroker:
+    # The part of RabbitMQ the chat uses: the default exchange, CHAT_EXCHANGE bindings by queue name and CC.
+    # Every queue is drained by the inbox of one consumer, messages that come before it are kept
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inboxes = dict() # queue -> Queue of (queue, method, properties, body)
+        self.bound = set() # Queues bound to CHAT_EXCHANGE with their own name
+
+    def declare(self, queue, inbox=None, bind=False):
+        with self.lock:
+            if bind:
+                self.bound.add(queue)
+            waiting = self.inboxes.get(queue)
+            if inbox is None:
+                if waiting is None:
+                    self.inboxes[queue] = Queue()
+                return
+            self.inboxes[queue] = inbox
+        while waiting is not None and not waiting.empty():
+            inbox.put(waiting.get())
+
+    def publish(self, exchange, routing_key, body, headers=None):
+        keys = [routing_key] + list((headers or {}).get("CC", []))
+        method = pika.spec.Basic.Deliver(exchange=exchange, routing_key=routing_key)
+        properties = pika.BasicProperties(headers=headers)
+        with self.lock:
+            inboxes = [(key, self.inboxes[key]) for key in dict.fromkeys(keys)
+                       if key in self.inboxes and (exchange == "" or key in self.bound)]
+        for queue, inbox in inboxes:
+            inbox.put((queue, method, properties, body))
+
+
+memory_broker = MemoryBroker()
+
+
+class Publisher:
+    # One long-lived connection and channel owned by a background thread. Messages are queued by publish()
+    # and sent in batches, the connection is re-established when the broker goes away
+    def __init__(self, host=RABBITMQ_HOST, queues=()):
+        self.host = host
+        self.queues = list(queues) # Declared on every (re)connect
+        self.outbox = Queue()
+        self.connection = None
+        self.channel = None
+        if self.host == MEMORY_HOST:
+            for queue in self.queues:
+                memory_broker.declare(queue)
+            return
+        threading.Thread(target=self.run, daemon=True, name="publisher").start()
+
+    def publish(self, exchange, routing_key, body, headers=None):
+        body = body.encode() if isinstance(body, str) else body
+        if self.host == MEMORY_HOST:
+            memory_broker.publish(exchange, routing_key, body, headers)
+            return
+        self.outbox.put((exchange, routing_key, body, headers))
+
+    def publish_many(self, routing_keys, body):
+        # One publish delivered to every routing key in CHAT_EXCHANGE (RabbitMQ sender-selected distribution)
+        routing_keys = list(routing_keys)
+        if not routing_keys:
+            return
+        headers = {"CC": routing_keys[1:]} if len(routing_keys) > 1 else None
+        self.publish(CHAT_EXCHANGE, routing_keys[0], body, headers)
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=CHAT_EXCHANGE, exchange_type="direct")
+        for queue in self.queues:
+            self.channel.queue_declare(queue=queue)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.outbox.get(timeout=FLUSH_PERIOD)]
+            except Empty:
+                batch = []
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.outbox.get_nowait())
+                except Empty:
+                    break
+
+            while True:
+                try:
+                    if self.connection is None or self.connection.is_closed:
+                        self.connect()
+                    for exchange, routing_key, body, headers in batch:
+                        properties = pika.BasicProperties(headers=headers) if headers else None
+                        self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+                    self.connection.process_data_events(time_limit=0)
+                    break
+                except pika.exceptions.AMQPError:
+                    logger.info("Lost connection to rabbitmq, reconnecting...")
+                    self.connection = None
+                    time.sleep(RECONNECT_DELAY)
+
+
+class ConsumerGroup:
+    # Consumes several queues on one connection and thread, (re)connecting in the background
+    # so that nobody has to wait for the broker to come up. callbacks is a dict of queue -> callback
+    def __init__(self, callbacks, host=RABBITMQ_HOST, bind=False):
+        self.host = host
+        self.callbacks = dict(callbacks)
+        self.bind = bind # Bind every queue to CHAT_EXCHANGE with its own name as the routing key
+        threading.Thread(target=self.run, daemon=True, name="consumer").start()
+
+    def deliver(self, queue, channel, method, properties, body):
+        # A message that breaks the callback is dropped, an exception here would stop consuming for everyone
+        try:
+            self.callbacks[queue](channel, method, properties, body)
+        except Exception:
+            logger.exception("Failed to handle a message from %s", queue)
+
+    def run(self):
+        if self.host == MEMORY_HOST:
+            inbox = Queue()
+            for queue in self.callbacks:
+                memory_broker.declare(queue, inbox, self.bind)
+            while True:
+                queue, method, properties, body = inbox.get()
+                self.deliver(queue, None, method, properties, body)
+
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+                channel = connection.channel()
+                if self.bind:
+                    channel.exchange_declare(exchange=CHAT_EXCHANGE, exchange_type="direct")
+                for queue in self.callbacks:
+                    channel.queue_declare(queue=queue)
+                    if self.bind:
+                        channel.queue_bind(queue=queue, exchange=CHAT_EXCHANGE, routing_key=queue)
+                    channel.basic_consume(queue=queue, auto_ack=True,
+                                          on_message_callback=lambda *message, queue=queue: self.deliver(queue, *message))
+                channel.start_consuming()
+            except pika.exceptions.AMQPError:
+                logger.info("Waiting for rabbitmq server...")
+                time.sleep(RECONNECT_DELAY)
+
+
+class Consumer(ConsumerGroup):
+    # Consumes one queue
+    def __init__(self, queue, callback, host=RABBITMQ_HOST, bind=False):
+        self.queue = queue
+        ConsumerGroup.__init__(self, {queue: callback}, host, bind)
@@ -1,40 +1,41 @@
-from concurrent import futures
 import logging
 import os, sys
 import random
-import pika
-import threading
-from time import sleep
+import time
 
 sys.path.append("../protos")
 
 import grpc
-import server_pb2_grpc, messages_pb2, client_pb2_grpc
+import server_pb2_grpc, messages_pb2
 
+import logs
 from mafia import Actions
+from chat import Publisher, Consumer, SERVER_QUEUE, RECONNECT_DELAY
+
+TIMEOUT = 0.2
+
+logger = logging.getLogger("Client")
+session_logger = logging.getLogger("Client.session")
+action_logger = logging.getLogger("Client.action")
+notification_logger = logging.getLogger("Client.notification")
+chat_logger = logging.getLogger("Client.chat")
+ping_logger = logging.getLogger("Client.ping")
 
 def generate_message():
     return f'''{random.choice(["This", "The current", "The aforementioned", "The ongoing"])} game is {random.choice(["marvelous", "fascinating", "oustanding", "exceeding all expectations"])}{random.choice(["?", "!", ".", "?!", "..."])}'''
 
-class Client(client_pb2_grpc.ClientServicer):
+class Client:
     def __init__(self, address, name):
         self.server_stub = None
         self.address = address
         self.name = name
         self.connected_players = []
+        self.last_seq = 0 # Of the last event from the server
+        self.chat_queue = SERVER_QUEUE # The server (the node, behind a router) tells where to send chat messages
 
         # Handle incoming messages
-        while True:
-            try:
-                connection = pika.BlockingConnection(pika.ConnectionParameters(host="rabbitMQService"))
-                channel = connection.channel()
-                channel.queue_declare(queue=str(self.address))
-                channel.basic_consume(queue=str(self.address), on_message_callback=Client.MessageCallback, auto_ack=True)
-                threading.Thread(target=lambda:channel.start_consuming()).start()
-                break
-            except:
-                logging.info("Waiting for rabbitmq server...")
-                sleep(3)
+        self.consumer = Consumer(str(self.address), Client.MessageCallback, bind=True)
+        self.publisher = Publisher(queues=[SERVER_QUEUE])
 
     def link_to_server(self, stub):
         self.server_stub = stub
@@ -48,110 +49,128 @@ class Client(client_pb2_grpc.ClientServicer):
         answer = self.server_stub.Register(mes)
 
         if answer.status != messages_pb2.RegisterResult.Status.OK:
-            logger.info("Got registration status " + str(answer.status))
+            logger.info("Got registration status %s", answer.status)
             logger.info("Something is wrong, exiting")
             exit(1)
         else:
             self.name = answer.name
-            logger.info("Successfully registered at the server as " + answer.name)
-            logger.info(f"Currently connected players (apart from me, {self.name}), are: {','.join(answer.users)}")
+            self.chat_queue = answer.chat_queue or SERVER_QUEUE
+            self.last_seq = 0
+            logger.info("Successfully registered at the server as %s", answer.name)
+            logger.info("Currently connected players (apart from me, %s), are: %s", self.name, logs.Lazy(",".join, list(answer.users)))
     
-    def NotifyJoin(self, request, context):
+    def listen(self):
+        # Everything from the server comes through the Events stream. After a broken connection the stream is
+        # resumed after the last event seen, if the server has dropped us we register again
+        handlers = {"new_game": self.NewGame, "join": self.NotifyJoin, "leave": self.NotifyLeave,
+                    "notification": self.GameNotify, "role": self.SendRole, "options": self.GiveActionOptions}
+        while True:
+            request = messages_pb2.EventsRequest()
+            request.address = self.address
+            request.last_seq = self.last_seq
+            try:
+                for batch in self.server_stub.Events(request):
+                    for event in batch.events:
+                        kind = event.WhichOneof("event")
+                        handlers[kind](getattr(event, kind))
+                        self.last_seq = event.seq
+                    if batch.ping:
+                        self.ack(batch.ping)
+                logger.info("The server has closed our session")
+                self.link_to_server(self.server_stub)
+            except grpc.RpcError as rpc_error:
+                if rpc_error.code() == grpc.StatusCode.NOT_FOUND:
+                    logger.info("The server has forgotten us")
+                    self.link_to_server(self.server_stub)
+                else:
+                    logger.info("Lost connection to the server (%s), reconnecting...", rpc_error.code())
+                    time.sleep(RECONNECT_DELAY)
+
+    def ack(self, ping):
+        # The answer to the server's heartbeat, also tells it which events we have
+        mes = messages_pb2.AckMessage()
+        mes.address = self.address
+        mes.last_seq = self.last_seq
+        mes.ping = ping
+        try:
+            self.server_stub.Ack(mes, timeout=TIMEOUT)
+        except grpc.RpcError as rpc_error:
+            ping_logger.info("Failed to answer ping (%s)", rpc_error.code())
+
+    def NotifyJoin(self, request):
         self.connected_players.append(request.name)
-        logger.info("Welcome, " + request.name)
-        logger.info(f"Currently connected players (apart from me, {self.name}), are: {','.join(self.connected_players)}")
+        session_logger.info("Welcome, %s", request.name)
+        session_logger.info("Currently connected players (apart from me, %s), are: %s", self.name, logs.Lazy(",".join, list(self.connected_players)))
         self.MaybeSendMessage()
-        return messages_pb2.NotifyJoinResponse()
     
-    def NotifyLeave(self, request, context):
+    def NotifyLeave(self, request):
         if request.name in self.connected_players:
             self.connected_players.remove(request.name)
-        logger.info("Goodbye, " + request.name)
-        logger.info(f"Currently connected players (apart from me, {self.name}), are: {','.join(self.connected_players)}")
+        session_logger.info("Goodbye, %s", request.name)
+        session_logger.info("Currently connected players (apart from me, %s), are: %s", self.name, logs.Lazy(",".join, list(self.connected_players)))
         self.MaybeSendMessage()
-        return messages_pb2.NotifyLeaveResponse()
 
-    def GameNotify(self, request, context):
-        logger.info(f"Got {request.type} notification from server: {request.text}")
+    def GameNotify(self, request):
+        notification_logger.info("Got %s notification from server: %s", request.type, request.text)
         self.MaybeSendMessage()
-        return messages_pb2.GameNotifyResponse()
     
     def human_readable_action(action):
         return f"({Actions(action.type).name} {action.arg})"
 
-    def GiveActionOptions(self, request, context):
-        # I could make this a pretty rpc call that returns the actions, however, that requires a quick answer (0.2 seconds timeout)
-        # A bot could make a decision this fast, but a human could not. Thus I make a separate rpc to set the choice in order to
-        # preserve the possibility to let humans play this game
+    def human_readable_actions(actions):
+        return [Client.human_readable_action(action) for action in actions]
+
+    def GiveActionOptions(self, request):
+        # The choice is sent with a separate rpc, so a human could take as long as they want to answer
         options = list(request.actions)
 
-        logger.info(f"My options are: {[Client.human_readable_action(x) for x in options]}")
+        # Formatted by the logging thread, and only if the record is written
+        action_logger.info("My options are: %s", logs.Lazy(Client.human_readable_actions, options))
         option = random.choice(options)
-        logger.info(f"I pick: {Client.human_readable_action(option)}")
+        action_logger.info("I pick: %s", logs.Lazy(Client.human_readable_action, option))
 
         action_mes = messages_pb2.TakeActionMessage()
         action_mes.address = self.address
         action_mes.action.CopyFrom(option)
         result = self.server_stub.TakeAction(action_mes)
-        logger.info(f"Status is {str(result.status)}")
+        action_logger.info("Status is %s", result.status)
 
         self.MaybeSendMessage()
 
-        return messages_pb2.ActionOptionsResponse()
-
-    def Ping(self, request, context):
-        self.MaybeSendMessage()
-        return request
-    
-    def SendRole(self, request, context):
-        logger.info(f"My role is {request.role}")
+    def SendRole(self, request):
+        notification_logger.info("My role is %s", request.role)
         self.MaybeSendMessage()
-        return messages_pb2.SendRoleResponse()
     
-    def NewGame(self, request, context):
+    def NewGame(self, request):
         self.connected_players = request.users
-        logger.info(f"I entered session ({request.game_id}). With players {', '.join(self.connected_players)} and me, {self.name}")
+        session_logger.info("I entered session (%s). With players %s and me, %s", request.game_id, logs.Lazy(", ".join, list(self.connected_players)), self.name)
         self.MaybeSendMessage()
-        return messages_pb2.NewGameResponse()
     
     def MessageCallback(channel, method, properties, body):
-        logger.info(f"Got chat message: {body.decode()}")
+        chat_logger.info("Got chat message: %s", logs.Lazy(bytes.decode, body, "utf-8", "replace"))
     
     def MaybeSendMessage(self):
         if random.randint(0, 20) == 0:
             mes = generate_message()
-            logger.info(f"Sending message to server: {mes}")
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host="rabbitMQService"))
-            channel = connection.channel()
-            channel.queue_declare(str(self.address) + "_out")
-            channel.basic_publish(exchange='', routing_key=str(self.address) + "_out", body=mes.encode())
-            connection.close()
+            chat_logger.info("Sending message to server: %s", mes)
+            self.publisher.publish("", self.chat_queue, mes, headers={"address": self.address})
 
 def serve():
     name = os.getenv("USERNAME")
 
-    address = "0.0.0.0:" + os.environ.get('CLIENT_PORT', '51076')
-
-    address_for_server = os.environ.get('CLIENT_ADDRESS', address)
+    # The address is only our id at the server and the name of our chat queue, the server does not connect to us
+    address = os.environ.get('CLIENT_ADDRESS', "0.0.0.0:" + os.environ.get('CLIENT_PORT', '51076'))
 
     server_address = os.environ.get('SERVER_ADDRESS', '51075')
     channel = grpc.insecure_channel(server_address)
     stub = server_pb2_grpc.ServerStub(channel)
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    client_instance = Client(address_for_server, name)
-    client_pb2_grpc.add_ClientServicer_to_server(client_instance, server)
-    server.add_insecure_port(address)
-    server.start()
-    logger.info("Started client at address " + address)
-
+    client_instance = Client(address, name)
     client_instance.link_to_server(stub)
-
-    server.wait_for_termination();
+    client_instance.listen()
 
 
 if __name__ == '__main__':
-    logger = logging.getLogger("Client")
-    logger.setLevel(level=logging.DEBUG)
+    logs.setup()
     logger.info("Trying to start client")
     serve()
@@ -0,0 +1,141 @@
+from concurrent.futures import Future
+from collections import deque
+import itertools
+import threading
+
+import messages_pb2
+
+import metrics
+
+MAX_BATCH = 256 # Events in one EventBatch
+
+EVENTS = metrics.Counter("mafia_events_total", "Events queued for clients")
+BATCH_EVENTS = metrics.Histogram("mafia_event_batch_size", "Events in one EventBatch", metrics.SIZES)
+
+
+class ClientEvents:
+    # Everything the server sends to one client, as numbered events for its Events stream. Events are kept until
+    # the client acknowledges them, so a client that reconnects gets everything after the last event it has seen.
+    # The methods that queue events have the names of the old per-event calls, Sessions uses them through send.
+    # A transport subclass implements changed (wake the stream) and the waiting
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+        self.game_id = None
+
+        self.lock = threading.Lock()
+        self.seq = 0 # Of the last queued event
+        self.unacked = deque() # Queued events the client has not acknowledged, in order
+        self.sent_seq = 0 # Of the last event given to the current stream
+        self.stream = 0 # Id of the current stream, an older stream ends when a new one is attached
+        self.closed = False
+
+        self.ping_ids = itertools.count(1)
+        self.pings = dict() # ping id -> Future, until the client answers it
+        self.ping_due = 0 # Ping id to put in the next batch
+
+    def changed(self):
+        raise NotImplementedError
+
+    def push(self, event):
+        with self.lock:
+            if self.closed:
+                return
+            self.seq += 1
+            event.seq = self.seq
+            self.unacked.append(event)
+        EVENTS.inc()
+        self.changed()
+
+    def attach(self, last_seq):
+        # A new stream takes over, it starts with the events after last_seq. Returns the id of the stream
+        with self.lock:
+            self.drop_acked(last_seq)
+            self.sent_seq = min(last_seq, self.seq)
+            self.stream += 1
+            stream = self.stream
+        self.changed() # Ends the previous stream
+        return stream
+
+    def drop_acked(self, last_seq):
+        # Must be called with the lock held
+        while self.unacked and self.unacked[0].seq <= last_seq:
+            self.unacked.popleft()
+
+    def is_current(self, stream):
+        return not self.closed and stream == self.stream
+
+    def has_news(self):
+        # Must be called with the lock held
+        return self.ping_due or (self.unacked and self.unacked[-1].seq > self.sent_seq)
+
+    def take_batch(self):
+        # Must be called with the lock held. The events the current stream has not had yet and the ping, if any
+        batch = messages_pb2.EventBatch()
+        if self.unacked:
+            start = max(0, self.sent_seq + 1 - self.unacked[0].seq) # The numbers in unacked have no gaps
+            batch.events.extend(itertools.islice(self.unacked, start, start + MAX_BATCH))
+        if batch.events:
+            self.sent_seq = batch.events[-1].seq
+            if BATCH_EVENTS.sampled():
+                BATCH_EVENTS.observe(len(batch.events))
+        batch.ping, self.ping_due = self.ping_due, 0
+        return batch
+
+    def ack(self, last_seq, ping):
+        with self.lock:
+            self.drop_acked(last_seq)
+            future = self.pings.pop(ping, None)
+        if future is not None:
+            future.set_result(None)
+
+    def Ping(self):
+        # A future that is done when the client answers, for heartbeat.Heartbeat (which gives up on it after a timeout)
+        future = Future()
+        with self.lock:
+            self.pings.clear() # Unanswered ones have already been counted as missed
+            self.ping_due = next(self.ping_ids)
+            self.pings[self.ping_due] = future
+        self.changed()
+        return future
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.changed()
+
+    def new_game(self, players, game_id):
+        event = messages_pb2.Event()
+        event.new_game.users.extend(players)
+        event.new_game.game_id = game_id
+        self.push(event)
+
+    def NotifyNewPerson(self, name):
+        event = messages_pb2.Event()
+        event.join.name = name
+        self.push(event)
+
+    def NotifyPersonLeave(self, name):
+        event = messages_pb2.Event()
+        event.leave.name = name
+        self.push(event)
+
+    def game_notification(self, notification):
+        event = messages_pb2.Event()
+        event.notification.type = str(notification[0])
+        event.notification.text = notification[1]
+        self.push(event)
+
+    def send_role(self, role):
+        event = messages_pb2.Event()
+        event.role.role = str(role)
+        self.push(event)
+
+    def give_options(self, options):
+        event = messages_pb2.Event()
+        for option in options:
+            action = event.options.actions.add()
+            action.type = option[0].value
+            if len(option) == 2:
+                action.arg = option[1]
+        self.push(event)
@@ -0,0 +1,113 @@
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+ping_logger = logging.getLogger("SERVER.ping")
+
+PING_RTT = metrics.Histogram("mafia_ping_rtt_seconds", "Time until a client answered a ping")
+PING_MISSES = metrics.Counter("mafia_ping_misses_total", "Pings that were not answered in time")
+DEAD_CLIENTS = metrics.Counter("mafia_dead_clients_total", "Clients removed for not answering pings")
+
+
+class ClientHealth:
+    def __init__(self, ping, next_ping):
+        self.ping = ping # Returns a future that is done when the client answers
+        self.next_ping = next_ping
+        self.in_flight = False
+        self.sent = None
+        self.attempt = 0 # Number of the ping in flight, a late answer to an older one is ignored
+        self.misses = 0
+        self.rtt = None # Smoothed round trip time in seconds
+
+
+class Heartbeat:
+    # Pings every client once per interval without blocking anything: pings are asynchronous and
+    # each client gets its own phase inside the interval, so checks are spread out instead of bursting.
+    # A client is reported dead after `misses` unanswered pings in a row, a ping is unanswered after `timeout` seconds
+    def __init__(self, interval, misses, timeout, on_dead, slow_rtt=None):
+        self.interval = interval
+        self.misses = misses
+        self.timeout = timeout
+        self.on_dead = on_dead
+        self.slow_rtt = slow_rtt
+        self.lock = threading.Lock()
+        self.clients = dict()
+
+    def add(self, address, ping):
+        with self.lock:
+            self.clients[address] = ClientHealth(ping, time.monotonic() + random.uniform(0, self.interval))
+
+    def remove(self, address):
+        with self.lock:
+            self.clients.pop(address, None)
+
+    def tick(self):
+        now = time.monotonic()
+        due = []
+        dead = []
+        with self.lock:
+            for address, health in self.clients.items():
+                if health.in_flight and now - health.sent > self.timeout:
+                    health.in_flight = False
+                    if self.missed(address, health):
+                        dead.append(address)
+                if health.next_ping <= now and not health.in_flight:
+                    health.in_flight = True
+                    health.next_ping = now + self.interval
+                    health.sent = now
+                    health.attempt += 1
+                    due.append((address, health, health.attempt))
+            for address in dead:
+                self.clients.pop(address)
+
+        for address in dead:
+            self.on_dead(address)
+
+        for address, health, attempt in due:
+            try:
+                future = health.ping()
+            except Exception:
+                ping_logger.exception("Failed to ping %s", address)
+                continue # Counted as missed after the timeout
+            future.add_done_callback(lambda future, address=address, health=health, attempt=attempt: self.on_result(address, health, attempt, future))
+
+    def missed(self, address, health):
+        # Must be called with the lock held, returns whether the client is dead now
+        health.misses += 1
+        PING_MISSES.inc()
+        ping_logger.info("Client %s failed to answer ping (%s/%s)", address, health.misses, self.misses)
+        if health.misses < self.misses:
+            return False
+        DEAD_CLIENTS.inc()
+        return True
+
+    def on_result(self, address, health, attempt, future):
+        dead = False
+        with self.lock:
+            if self.clients.get(address) is not health or not health.in_flight or health.attempt != attempt:
+                return # Removed or timed out while the ping was in flight
+            health.in_flight = False
+
+            if future.exception() is None:
+                rtt = time.monotonic() - health.sent
+                PING_RTT.observe(rtt)
+                health.rtt = rtt if health.rtt is None else 0.8 * health.rtt + 0.2 * rtt
+                health.misses = 0
+                if self.slow_rtt is not None and health.rtt > self.slow_rtt:
+                    ping_logger.info("Client %s is slow, rtt is %.1fms", address, health.rtt * 1000)
+            else:
+                ping_logger.info("Unexpected ping error from %s: %s", address, future.exception())
+                if self.missed(address, health):
+                    self.clients.pop(address)
+                    dead = True
+
+        if dead:
+            self.on_dead(address)
+
+    def rtts(self):
+        # Round trip time of every client that answered at least once, address -> seconds
+        with self.lock:
+            return {address: health.rtt for address, health in self.clients.items() if health.rtt is not None}
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+import time
+from queue import SimpleQueue, Empty
+
+from mafia import GameState, Actions
+
+# Crash recovery of the games. Every transition of a GameState (a player joins or leaves, the game starts with
+# the seed of its roles, an action is taken) is appended to the journal, the phase changes follow from those
+# when the records are replayed. A writer thread writes whatever has queued up and syncs it to disk once for
+# the whole group, so for the game a transition costs a queue put.
+# The writer applies the records to its own copies of the games, and every SNAPSHOT_EVERY records it writes all
+# of them to a snapshot and starts a new journal segment. Recovery reads the last snapshot and the records after
+# it, so it takes as long as the current games are big, not as long as the server has been running.
+# Results of finished games stay in the journal until the stats reporter has sent them to the rest api server.
+#
+# Records are JSON lists, one per line: [game_id, kind, ...], where kind is add, remove, start, action,
+# finish (the game is over, with its results) or reported (game_id is null, with the ids of the reported games)
+
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR") # No journal if not set
+SNAPSHOT_EVERY = int(os.environ.get("JOURNAL_SNAPSHOT_EVERY", 100000)) # Records between snapshots
+GROUP_COMMIT_SIZE = 4096 # Most records written with one sync
+
+logger = logging.getLogger("JOURNAL")
+
+
+def replay(games, unreported, record):
+    # Applies one record to the games (game_id -> GameState) and the unreported results (game_id -> [results, ingame])
+    game_id, kind, args = record[0], record[1], record[2:]
+    if kind == "reported":
+        for reported in args[0]:
+            unreported.pop(reported, None)
+        return
+    if kind == "finish":
+        games.pop(game_id, None)
+        if args[0] is not None:
+            unreported[game_id] = list(args)
+        return
+
+    game = games.get(game_id)
+    if game is None:
+        game = games[game_id] = GameState()
+    if kind == "add":
+        game.add_player(args[0])
+    elif kind == "remove":
+        game.remove_player(args[0])
+    elif kind == "start":
+        game.start_game(args[0])
+        game.start_time = args[1]
+    elif kind == "action":
+        game.try_action(args[0], (Actions(args[1]),) if args[2] is None else (Actions(args[1]), args[2]))
+    game.forget_events()
+
+
+class Journal:
+    def __init__(self, directory):
+        self.directory = directory
+        self.records = SimpleQueue()
+        self.games = dict() # game_id -> GameState, the writer's copies of the games
+        self.unreported = dict() # game_id -> [results, ingame] of a finished game
+        self.last_game_id = 0
+        self.segment = 0 # Number of the segment being written
+        self.file = None
+        self.written = 0 # Records in the segment
+
+    def recorder(self, game_id):
+        # The GameState.journal of a game
+        return lambda *record: self.records.put((game_id,) + record)
+
+    def append(self, game_id, *record):
+        self.records.put((game_id,) + record)
+
+    def extend(self, records):
+        # Records made somewhere else (in a shard), each starts with the game id
+        for record in records:
+            self.records.put(record)
+
+    def path(self, kind, number):
+        return os.path.join(self.directory, f"{kind}-{number:08d}." + ("json" if kind == "snapshot" else "log"))
+
+    def numbered(self, kind):
+        # Numbers of the snapshots or segments in the directory, in order
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(kind + "-") and not name.endswith(".tmp"):
+                numbers.append(int(name[len(kind) + 1:].split(".")[0]))
+        return sorted(numbers)
+
+    def recover(self):
+        # Reads the last snapshot and the segments after it, and starts the writer. Returns the games of the previous
+        # run (game_id -> GameState.snapshot()), their unreported results and the last game id
+        start_time = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        snapshots = self.numbered("snapshot")
+        segments = self.numbered("segment")
+        first = snapshots[-1] if snapshots else 0 # Snapshot n holds everything before segment n
+        if snapshots:
+            with open(self.path("snapshot", first)) as file:
+                state = json.load(file)
+            self.games = {int(game_id): GameState.restore(game) for game_id, game in state["games"].items()}
+            self.unreported = {int(game_id): results for game_id, results in state["unreported"].items()}
+            self.last_game_id = state["last_game_id"]
+
+        replayed = 0
+        for number in segments:
+            if number >= first:
+                replayed += self.replay_segment(number)
+
+        # Everything recovered goes to a new snapshot, the records of this run to a new segment
+        self.segment = max(segments + [first]) + 1
+        self.write_snapshot()
+        self.file = open(self.path("segment", self.segment), "a")
+        logger.info("Recovered %s games and %s unreported results from snapshot %s and %s records in %.3fs",
+                    len(self.games), len(self.unreported), first, replayed, time.monotonic() - start_time)
+
+        threading.Thread(target=self.run, daemon=True, name="journal").start()
+        return {game_id: game.snapshot() for game_id, game in self.games.items()}, dict(self.unreported), self.last_game_id
+
+    def replay_segment(self, number):
+        replayed = 0
+        with open(self.path("segment", number)) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.info("Segment %s ends with a broken record, it was being written when the server stopped", number)
+                    break
+                self.apply(record)
+                replayed += 1
+        return replayed
+
+    def apply(self, record):
+        if record[0] is not None:
+            self.last_game_id = max(self.last_game_id, record[0])
+        try:
+            replay(self.games, self.unreported, record)
+        except Exception:
+            logger.exception("Failed to apply journal record %s", record)
+
+    def write_snapshot(self):
+        # Snapshot self.segment: the state after every segment before it
+        state = {"last_game_id": self.last_game_id, "games": {game_id: game.snapshot() for game_id, game in self.games.items()},
+                 "unreported": self.unreported}
+        path = self.path("snapshot", self.segment)
+        with open(path + ".tmp", "w") as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory) # Makes the rename durable
+        finally:
+            os.close(directory)
+
+        # Older snapshots and segments are not needed any more
+        for kind in ("snapshot", "segment"):
+            for number in self.numbered(kind):
+                if number < self.segment:
+                    os.remove(self.path(kind, number))
+
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < GROUP_COMMIT_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except Empty:
+                    break
+
+            for record in batch:
+                self.apply(record)
+            self.file.write("".join(json.dumps(record) + "\n" for record in batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            self.written += len(batch)
+            if self.written >= SNAPSHOT_EVERY:
+                self.file.close()
+                self.segment += 1
+                self.write_snapshot()
+                self.file = open(self.path("segment", self.segment), "a")
+                self.written = 0
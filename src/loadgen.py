@@ -0,0 +1,228 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+
+import grpc
+import server_pb2_grpc, messages_pb2
+
+from chat import ConsumerGroup, Publisher, SERVER_QUEUE
+from client import generate_message
+
+# Many bot clients in one process: every bot has its own Events stream, all of them on one grpc.aio channel.
+# Bots behave like client.py, with settable think time, chat and disconnect rates, and the generator records
+# end-to-end latencies
+
+logger = logging.getLogger("LOADGEN")
+
+RETRY_DELAY = 0.5 # Before registering again when the server still has the previous session of the address or is unavailable
+
+
+class Latencies:
+    # Seconds, by kind of measurement
+    def __init__(self):
+        self.samples = dict()
+
+    def add(self, kind, seconds):
+        self.samples.setdefault(kind, []).append(seconds)
+
+    def count(self, kind):
+        return len(self.samples.get(kind, []))
+
+    def percentile(self, kind, fraction):
+        samples = sorted(self.samples.get(kind, []))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class VirtualClient:
+    def __init__(self, load, number):
+        self.load = load
+        self.address = f"loadgen-{number}" # The id at the server and the name of the chat queue
+        self.name = f"Bot{number}"
+        self.chat_queue = SERVER_QUEUE
+        self.online = False
+        self.in_game = False
+        self.listener = None
+        self.last_seq = 0
+        self.registered_at = None # Until the first NewGame after the registration
+        self.waiting_since = None # Until the first game after the registration starts
+        self.acted_at = None # Until the next prompt after an action
+
+    async def connect(self):
+        request = messages_pb2.RegisterMessage()
+        request.address = self.address
+        request.name = self.name
+        while True:
+            start = time.perf_counter()
+            try:
+                answer = await self.load.stub.Register(request, wait_for_ready=True) # The server may still be starting
+                if answer.status == messages_pb2.RegisterResult.Status.OK:
+                    break
+            except grpc.RpcError as rpc_error:
+                logger.info("%s failed to register: %s", self.name, rpc_error.code())
+            await asyncio.sleep(RETRY_DELAY)
+        self.load.latencies.add("register", time.perf_counter() - start)
+        self.name = answer.name
+        self.chat_queue = answer.chat_queue or SERVER_QUEUE
+        self.online = True
+        self.registered_at = self.waiting_since = start
+        self.last_seq = 0
+        self.listener = self.load.spawn(self.listen())
+
+    async def listen(self):
+        handlers = {"new_game": self.new_game, "notification": self.game_notification, "options": self.give_options}
+        request = messages_pb2.EventsRequest()
+        request.address = self.address
+        try:
+            async for batch in self.load.stub.Events(request):
+                for event in batch.events:
+                    kind = event.WhichOneof("event")
+                    if kind in handlers:
+                        handlers[kind](getattr(event, kind))
+                    self.load.counters["events"] += 1
+                    self.last_seq = event.seq
+                if batch.ping:
+                    ack = messages_pb2.AckMessage()
+                    ack.address = self.address
+                    ack.last_seq = self.last_seq
+                    ack.ping = batch.ping
+                    self.load.spawn(self.load.stub.Ack(ack))
+        except grpc.RpcError as rpc_error:
+            logger.info("%s lost its stream: %s", self.name, rpc_error.code())
+
+        # The server has dropped the bot (or could not be reached), it starts over like client.py does
+        self.online = False
+        self.in_game = False
+        self.registered_at = self.waiting_since = self.acted_at = None
+        self.load.counters["dropped by server"] += 1
+        await asyncio.sleep(self.load.reconnect_delay)
+        await self.connect()
+
+    async def disconnect(self):
+        self.online = False
+        self.in_game = False
+        self.registered_at = self.waiting_since = self.acted_at = None
+        self.listener.cancel()
+        request = messages_pb2.LeaveMessage()
+        request.address = self.address
+        await self.load.stub.Leave(request)
+
+    def new_game(self, details):
+        if self.registered_at is not None:
+            self.load.latencies.add("register -> NewGame", time.perf_counter() - self.registered_at)
+            self.registered_at = None
+        self.in_game = True
+        self.acted_at = None
+        self.load.counters["games joined"] += 1
+
+    def game_notification(self, notification):
+        if notification.type == "Notification.GameStarts" and self.waiting_since is not None:
+            self.load.latencies.add("register -> game start", time.perf_counter() - self.waiting_since)
+            self.waiting_since = None
+        if notification.type == "Notification.GameOver":
+            self.in_game = False
+            self.acted_at = None
+
+    def give_options(self, options):
+        if self.acted_at is not None:
+            self.load.latencies.add("action -> next prompt", time.perf_counter() - self.acted_at)
+            self.acted_at = None
+        if options.actions:
+            self.load.spawn(self.act(random.choice(options.actions)))
+
+    async def act(self, option):
+        await asyncio.sleep(random.uniform(0, 2 * self.load.think_time))
+        if not self.online:
+            return
+        request = messages_pb2.TakeActionMessage()
+        request.address = self.address
+        request.action.CopyFrom(option)
+        start = time.perf_counter()
+        self.acted_at = start # The next prompt may come before the call returns
+        await self.load.stub.TakeAction(request)
+        self.load.latencies.add("TakeAction", time.perf_counter() - start)
+        self.load.counters["actions"] += 1
+
+    async def chat(self):
+        while True:
+            await asyncio.sleep(random.expovariate(self.load.chat_rate))
+            if self.online and self.in_game:
+                self.load.send_message(self)
+
+    async def drop_out(self):
+        while True:
+            await asyncio.sleep(random.expovariate(self.load.disconnect_rate))
+            if self.online:
+                self.load.counters["disconnects"] += 1
+                await self.disconnect()
+                await asyncio.sleep(self.load.reconnect_delay)
+                await self.connect()
+
+
+class LoadGenerator:
+    # think_time is the mean delay before a bot answers a prompt, chat_rate and disconnect_rate are
+    # per bot per second (0 turns them off), a bot that left registers again after reconnect_delay
+    def __init__(self, server_address, clients, think_time=0.5, chat_rate=0.05, disconnect_rate=0, reconnect_delay=1):
+        self.server_address = server_address
+        self.think_time = think_time
+        self.chat_rate = chat_rate
+        self.disconnect_rate = disconnect_rate
+        self.reconnect_delay = reconnect_delay
+        self.clients = [VirtualClient(self, number) for number in range(clients)]
+
+        self.latencies = Latencies()
+        self.counters = dict.fromkeys(["games joined", "events", "actions", "disconnects", "dropped by server", "chat sent", "chat received"], 0)
+        self.sent = dict() # Chat message token -> when it was published
+        self.tokens = itertools.count()
+        self.tasks = set() # The event loop only keeps weak references to tasks
+        self.loop = None
+        self.stub = None
+        self.publisher = None
+
+    def spawn(self, awaitable):
+        task = asyncio.ensure_future(awaitable)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def send_message(self, client):
+        # The token at the end of the text lets the receivers find out when it was sent
+        token = f"#{next(self.tokens)}"
+        self.sent[token] = time.perf_counter()
+        self.counters["chat sent"] += 1
+        self.publisher.publish("", client.chat_queue, f"{generate_message()} {token}", headers={"address": client.address})
+
+    def on_chat_message(self, channel, method, properties, body):
+        # Called on the consumer thread
+        self.loop.call_soon_threadsafe(self.received, body, time.perf_counter())
+
+    def received(self, body, when):
+        self.counters["chat received"] += 1
+        sent = self.sent.get(body.decode(errors="replace").rsplit(" ", 1)[-1])
+        if sent is not None:
+            self.latencies.add("chat", when - sent)
+
+    async def run(self, duration):
+        self.loop = asyncio.get_running_loop()
+        channel = grpc.aio.insecure_channel(self.server_address)
+        self.stub = server_pb2_grpc.ServerStub(channel)
+        self.publisher = Publisher(queues=[SERVER_QUEUE])
+        ConsumerGroup({client.address: self.on_chat_message for client in self.clients}, bind=True)
+
+        logger.info("Registering %s clients at %s", len(self.clients), self.server_address)
+        await asyncio.gather(*(client.connect() for client in self.clients))
+        for client in self.clients:
+            if self.chat_rate:
+                self.spawn(client.chat())
+            if self.disconnect_rate:
+                self.spawn(client.drop_out())
+
+        await asyncio.sleep(duration)
+
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*(client.disconnect() for client in self.clients if client.online), return_exceptions=True)
+        await channel.close()
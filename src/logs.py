@@ -0,0 +1,208 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+# Logging of the server and the clients. A log call only checks the level, the category limits and puts the record
+# in a queue, a background thread formats and writes it. Messages use %-style arguments, so they are formatted by
+# that thread and only if the record is written.
+#
+# Records are grouped in categories, the part of the logger name after the first dot (SERVER.action is the
+# category action, SERVER is general). A category can be sampled and rate limited:
+#   LOG_SAMPLE="action=0.01,ping=0.1"  writes one record in a hundred / in ten
+#   LOG_RATE="chat=20"                 writes at most 20 records a second, the next written record tells how many were dropped
+# LOG_LEVEL sets the level, LOG_FORMAT=json writes one JSON object per line, LOG_FILE writes to a file instead of stderr.
+# EVENT_LOG=<path> also writes every record of EVENT_CATEGORIES (not sampled) to a binary file for offline
+# analysis, python logs.py <path> prints it as JSON lines
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_FILE = os.environ.get("LOG_FILE")
+EVENT_LOG = os.environ.get("EVENT_LOG")
+
+EVENT_CATEGORIES = ("action", "notification", "chat")
+
+# Attributes every LogRecord has, the others were given with extra= and go to the JSON records as they are
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled", "dropped"}
+
+
+def parse_limits(text):
+    # "action=0.01,chat=5" -> {"action": 0.01, "chat": 5.0}
+    limits = dict()
+    for item in (text or "").split(","):
+        if item.strip():
+            category, value = item.split("=")
+            limits[category.strip()] = float(value)
+    return limits
+
+
+def category_of(name):
+    return name.partition(".")[2] or "general"
+
+
+class Lazy:
+    # An argument that is computed only when the record is formatted: logger.info("%s", Lazy(function, value))
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+class Category:
+    def __init__(self, sample, rate):
+        self.every = round(1 / sample) if sample > 0 else 0 # 0 writes nothing
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.calls = 0
+        self.dropped = 0
+
+    def take(self):
+        # Must be called with the filter lock held, whether to write the record
+        self.calls += 1
+        if not self.every or self.calls % self.every:
+            return False
+        if self.rate is not None:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return False
+            self.tokens -= 1
+        return True
+
+
+class CategoryFilter(logging.Filter):
+    # Runs in the logging thread before the record is queued. Marks whether the record is written to the log
+    # (record.sampled) and lets through the ones the event log needs even if they are not
+    def __init__(self, level, samples, rates, event_log):
+        logging.Filter.__init__(self)
+        self.level = level
+        self.samples = samples
+        self.rates = rates
+        self.event_log = event_log
+        self.lock = threading.Lock()
+        self.categories = dict() # category -> Category, None if it has no limits
+
+    def filter(self, record):
+        name = category_of(record.name)
+        if name not in self.categories:
+            with self.lock:
+                if name in self.samples or name in self.rates:
+                    self.categories[name] = Category(self.samples.get(name, 1), self.rates.get(name))
+                else:
+                    self.categories[name] = None
+        category = self.categories[name]
+
+        record.sampled = record.levelno >= self.level
+        if record.sampled and category is not None:
+            with self.lock:
+                record.sampled = category.take()
+                if record.sampled and category.dropped:
+                    record.dropped, category.dropped = category.dropped, 0
+        return record.sampled or (self.event_log and name in EVENT_CATEGORIES)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The queue stays in this process, so the record is queued as it is instead of being formatted here.
+    # The arguments are formatted later, so they must not be changed after the call
+    def prepare(self, record):
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        if getattr(record, "dropped", 0):
+            text += f" ({record.dropped} more records of this category were dropped)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 6), "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if getattr(record, "dropped", 0):
+            entry["dropped"] = record.dropped
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class EventLogHandler(logging.Handler):
+    # Writes the records of EVENT_CATEGORIES as a header (time, category index, game id or -1, payload length)
+    # followed by the arguments of the record as UTF-8 separated by \x1f
+    HEADER = struct.Struct("<dBiI")
+
+    def __init__(self, path):
+        logging.Handler.__init__(self)
+        self.file = open(path, "ab")
+
+    def emit(self, record):
+        name = category_of(record.name)
+        if name not in EVENT_CATEGORIES:
+            return
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        payload = "\x1f".join(str(arg) for arg in args).encode(errors="replace")
+        game_id = getattr(record, "game", None)
+        self.file.write(self.HEADER.pack(record.created, EVENT_CATEGORIES.index(name), -1 if game_id is None else game_id, len(payload)))
+        self.file.write(payload)
+
+    def close(self):
+        self.file.close()
+        logging.Handler.close(self)
+
+
+def read_events(path):
+    # Yields (time, category, game id or None, arguments) from an event log
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(EventLogHandler.HEADER.size)
+            if len(header) < EventLogHandler.HEADER.size:
+                return
+            created, category, game_id, length = EventLogHandler.HEADER.unpack(header)
+            args = file.read(length).decode(errors="replace").split("\x1f")
+            yield created, EVENT_CATEGORIES[category], None if game_id == -1 else game_id, args
+
+
+def setup():
+    # Sends the records of all loggers through the queue, call once at the start of a program
+    level = logging.getLevelName(LOG_LEVEL)
+    output = logging.FileHandler(LOG_FILE) if LOG_FILE else logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    output.addFilter(lambda record: getattr(record, "sampled", True))
+    handlers = [output]
+    if EVENT_LOG:
+        handlers.append(EventLogHandler(EVENT_LOG))
+
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(CategoryFilter(level, parse_limits(os.environ.get("LOG_SAMPLE")), parse_limits(os.environ.get("LOG_RATE")), EVENT_LOG is not None))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(min(level, logging.INFO) if EVENT_LOG else level) # The event records are INFO
+
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+
+    def stop():
+        listener.stop() # Writes what is still queued
+        for output in handlers:
+            output.close()
+    atexit.register(stop)
+
+
+if __name__ == "__main__":
+    for created, category, game_id, args in read_events(sys.argv[1]):
+        print(json.dumps({"time": created, "category": category, "game": game_id, "args": args}, ensure_ascii=False))
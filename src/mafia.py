@@ -1,16 +1,10 @@
 from config import roles_config, Role
-from random import shuffle
+from random import Random, getrandbits
 from threading import Lock
 from enum import Enum
-from collections import deque
 import time
 
-
-class PlayerState:
-    def __init__(self, name):
-        self.name = name
-        self.role = None
-        self.alive = None
+MAX_PLAYERS = max(roles_config.keys())
 
 class States(Enum):
     Night = 0
@@ -30,74 +24,204 @@ class Notification(Enum):
     GameOver = 4 # The game is over
     GameStarts = 5 # Beginning of a game
 
+class Message(Enum):
+    # Texts of the notifications, a notification keeps only the code and the argument until it is sent
+    GameStarts = "A new mafia game is starting!"
+    Killed = "Player {} was killed by the mafia"
+    NoKill = "No one was killed by the mafia this night"
+    Checked = "The player checked by the police is a {}"
+    NoCheck = "The police failed to coordinate this night"
+    Morning = "Good morning! A new day is starting."
+    VotedOut = "Player {} was voted out"
+    NoVoteOut = "No one was voted out"
+    Night = "The day is over, night is starting."
+    CiviliansWin = "Civilians win!"
+    MafiaWins = "Mafia wins!"
+
 class ExpectedLockException(Exception):
     pass
 
+def members(mask):
+    # Indices of the set bits of a bitset, in increasing order
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class VoteTally:
+    # Votes of one voting (for any type of voting) with the number of votes for every target kept up to date,
+    # so the current winner is known at any moment without recounting. Changing a vote moves it between targets
+    __slots__ = ("votes", "counts", "by_count", "max_count")
+
+    def __init__(self):
+        self.votes = dict() # voter -> target
+        self.counts = dict() # target -> number of votes
+        self.by_count = dict() # number of votes -> set of targets with that many votes
+        self.max_count = 0
+
+    def vote(self, voter, target):
+        previous = self.votes.get(voter)
+        if previous == target:
+            return
+        if previous is not None:
+            self.move(previous, -1)
+        self.votes[voter] = target
+        self.move(target, 1)
+
+    def drop_target(self, target):
+        # Forgets all the votes for a target (for example, a player that left)
+        for voter in [voter for voter, voted in self.votes.items() if voted == target]:
+            self.votes.pop(voter)
+            self.move(target, -1)
+
+    def move(self, target, delta):
+        count = self.counts.get(target, 0)
+        if count:
+            self.by_count[count].discard(target)
+        count += delta
+        if count:
+            self.counts[target] = count
+            self.by_count.setdefault(count, set()).add(target)
+        else:
+            self.counts.pop(target)
+
+        if count > self.max_count:
+            self.max_count = count
+        while self.max_count and not self.by_count.get(self.max_count):
+            self.max_count -= 1
+
+    def leader(self):
+        # Independent expertise in who won the vote: the only target with the most votes, None on a tie
+        # Hoping this function will be used for the next elections in Russia
+        if not self.max_count or len(self.by_count[self.max_count]) != 1:
+            return None
+        return next(iter(self.by_count[self.max_count]))
+
 class GameState:
+    # Players are small indices in the order they joined: names[index] is the name (None once the player left),
+    # roles are kept in a bytearray and the alive/done flags and the valid targets of every action in bitsets
+    __slots__ = ("names", "index", "present", "roles", "alive", "mafia", "policemen", "done", "game_started", "day",
+                 "lock", "state", "votes", "mafia_votes", "policeman_votes", "alive_num", "alive_by_role", "done_num",
+                 "notifications", "await_actions", "mafia_won", "start_time", "journal")
+
     def __init__(self):
-        self.players = dict()
+        self.names = [] # index -> name
+        self.index = dict() # name -> index
+        self.present = 0 # Players that did not leave (bitset)
+        self.roles = None # index -> Role value (bytearray)
+        self.alive = 0 # Alive players, also the valid vote targets (bitset)
+        self.mafia = 0 # Mafia players, dead or alive (bitset)
+        self.policemen = 0 # Policemen, dead or alive (bitset)
+        self.done = 0 # Who is done for this day/night (bitset)
         self.game_started = False
         self.day = 0
         self.lock = Lock()
 
         self.state = None # Night/Day
-        self.votes = None # For who each player voted
-        self.mafia_votes = None # For who each mafia player voted at night
-        self.policeman_votes = None # For who each policeman player voted
-        self.done = None # Who is done for this day/night
+        # Per-phase tallies, created on the first vote of the phase
+        self.votes = None # For who each player voted (VoteTally)
+        self.mafia_votes = None # For who each mafia player voted at night (VoteTally)
+        self.policeman_votes = None # For who each policeman player voted (VoteTally)
         self.alive_num = None # How many are alive
+        self.alive_by_role = None # Role value -> how many of them are alive
         self.done_num = None # How many are done
 
-        self.notifications = deque() # Notifications for the server to send to the clients
-        self.await_actions = list() # List of people who we need to ask for actions
+        self.notifications = None # (Notification, Message, argument) for the server to send to the clients
+        self.await_actions = None # List of people who we need to ask for actions
 
         self.mafia_won = True
+        self.start_time = None
+        self.journal = None # Called with every transition, under the lock (see journal.py)
+
+    def notify(self, notification, message, argument=None):
+        if self.notifications is None:
+            self.notifications = []
+        self.notifications.append((notification, message, argument))
+
+    def wait_for(self, name):
+        if self.await_actions is None:
+            self.await_actions = []
+        self.await_actions.append(name)
 
     def add_player(self, name):
         with self.lock:
-            if self.game_started or len(self.players) + 1 > max(roles_config.keys()):
+            if self.game_started or len(self.index) + 1 > MAX_PLAYERS:
                 return False
-            self.players[name] = PlayerState(name)
+            self.index[name] = len(self.names)
+            self.present |= 1 << len(self.names)
+            self.names.append(name)
+            if self.journal is not None:
+                self.journal("add", name)
             return True
     
     def get_role(self, name):
         with self.lock:
             if not self.game_started:
                 return None
-            if name not in self.players:
+            if name not in self.index:
                 return None
-            return self.players[name].role
+            return Role(self.roles[self.index[name]])
 
     def remove_player(self, name):
         with self.lock:
-            if name in self.players:
-                self.players.pop(name)
+            if name in self.index:
+                if self.journal is not None:
+                    self.journal("remove", name)
+                player = self.index.pop(name)
+                bit = 1 << player
+                self.names[player] = None
+                self.present &= ~bit
+                if self.alive & bit:
+                    self.alive &= ~bit
+                    self.alive_by_role[self.roles[player]] -= 1
+                for tally in (self.votes, self.mafia_votes, self.policeman_votes):
+                    if tally is not None:
+                        tally.drop_target(player)
 
                 if self.game_started:
                     self.alive_num -= 1
                     self.check_done()
 
+    def player_count(self):
+        with self.lock:
+            return len(self.index)
+
     def is_ok(self):
         with self.lock:
-            return len(self.players) in roles_config
+            return len(self.index) in roles_config
+
+    def is_open(self):
+        # Whether one more player can still join
+        with self.lock:
+            return not self.game_started and len(self.index) < MAX_PLAYERS
 
-    def start_game(self):
+    def start_game(self, seed=None):
+        # The roles are shuffled with the seed, so a replay of the game gets the same ones
         with self.lock:
             if self.game_started:
                 return
+            if seed is None:
+                seed = getrandbits(64)
             self.start_time = time.time()
+            if self.journal is not None:
+                self.journal("start", seed, self.start_time)
             self.game_started = True
             roles = []
-            for role, number in roles_config[len(self.players)].items():
+            for role, number in roles_config[len(self.index)].items():
                 roles += [role] * number
-            shuffle(roles)
-            cnt = 0
-            for key in self.players:
-                self.players[key].role = roles[cnt]
-                self.players[key].alive = True
-                cnt += 1
-            self.alive_num = len(self.players)
-            self.notifications.append((Notification.GameStarts, "A new mafia game is starting!"))
+            Random(seed).shuffle(roles)
+            self.roles = bytearray(len(self.names))
+            self.alive_by_role = [0] * (len(Role) + 1)
+            for player, role in zip(members(self.present), roles):
+                self.roles[player] = role.value
+                self.alive_by_role[role.value] += 1
+                if role == Role.Mafia:
+                    self.mafia |= 1 << player
+                if role == Role.Policeman:
+                    self.policemen |= 1 << player
+            self.alive = self.present
+            self.alive_num = len(self.index)
+            self.notify(Notification.GameStarts, Message.GameStarts)
             self.setup_day()
 
     # Returns the list of possible actions for the player
@@ -108,32 +232,57 @@ class GameState:
             if not self.game_started:
                 return res
 
-            if name not in self.players:
+            player = self.index.get(name)
+            if player is None:
                 return res
 
-            if not self.players[name].alive:
+            bit = 1 << player
+            if not self.alive & bit:
                 return res
 
             if self.state == States.Day:
                 res.append((Actions.Sleep,))
                 if self.day > 1:
-                    for player, state in self.players.items():
-                        if player != name and state.alive:
-                            res.append((Actions.Vote, player))
+                    res.extend((Actions.Vote, self.names[target]) for target in members(self.alive & ~bit))
             else:
                 res.append((Actions.Wake,))
 
-                if self.players[name].role == Role.Mafia:
-                    for player, state in self.players.items():
-                        if state.role != Role.Mafia and state.alive:
-                            res.append((Actions.Kill, player))
+                if self.mafia & bit:
+                    res.extend((Actions.Kill, self.names[target]) for target in members(self.alive & ~self.mafia))
 
-                if self.players[name].role == Role.Policeman:
-                    for player, state in self.players.items():
-                        if state.role != Role.Policeman:
-                            res.append((Actions.Check, player))
+                if self.policemen & bit:
+                    res.extend((Actions.Check, self.names[target]) for target in members(self.present & ~self.policemen))
         return res
 
+    # Same as `action in self.actions(name)`, but without building the list
+    def is_allowed(self, name, action):
+        with self.lock:
+            return self.allowed(name, action)
+
+    def allowed(self, name, action):
+        player = self.index.get(name)
+        if not self.game_started or player is None or not self.alive >> player & 1:
+            return False
+
+        target = self.index.get(action[1]) if len(action) == 2 else None
+        target_bit = 1 << target if target is not None else 0
+        if self.state == States.Day:
+            if action[0] == Actions.Sleep:
+                return len(action) == 1
+            return action[0] == Actions.Vote and self.day > 1 and target != player and bool(self.alive & target_bit)
+
+        if action[0] == Actions.Wake:
+            return len(action) == 1
+        if action[0] == Actions.Kill:
+            return bool(self.mafia >> player & 1 and self.alive & ~self.mafia & target_bit)
+        if action[0] == Actions.Check:
+            return bool(self.policemen >> player & 1 and self.present & ~self.policemen & target_bit)
+        return False
+
+    def kill(self, player):
+        self.alive &= ~(1 << player)
+        self.alive_by_role[self.roles[player]] -= 1
+
     def check_done(self):
         if self.done_num == self.alive_num:
             if self.state == States.Day:
@@ -143,139 +292,214 @@ class GameState:
 
     def perform_action(self, name, action):
         with self.lock:
-            if action[0] == Actions.Sleep or action[0] == Actions.Wake:
-                if name not in self.done:
-                    self.done.add(name)
-                    self.done_num += 1
+            if self.journal is not None:
+                self.record(name, action)
+            self.apply(name, action)
 
-                self.check_done()
-            else:
-                if action[0] == Actions.Vote:
-                    self.votes[name] = action[1]
-                if action[0] == Actions.Kill:
-                    self.mafia_votes[name] = action[1]
-                if action[0] == Actions.Check:
-                    self.policeman_votes[name] = action[1]
-                
-                self.await_actions.append(name)
+    # Checks the action and performs it if it is allowed, in one go: nothing can change the game in between
+    def try_action(self, name, action):
+        with self.lock:
+            if not self.allowed(name, action):
+                return False
+            if self.journal is not None:
+                self.record(name, action)
+            self.apply(name, action)
+            return True
+
+    def record(self, name, action):
+        self.journal("action", name, action[0].value, action[1] if len(action) == 2 else None)
+
+    def apply(self, name, action):
+        player = self.index[name]
+        if action[0] == Actions.Sleep or action[0] == Actions.Wake:
+            if not self.done >> player & 1:
+                self.done |= 1 << player
+                self.done_num += 1
+
+            self.check_done()
+        else:
+            target = self.index[action[1]]
+            if action[0] == Actions.Vote:
+                if self.votes is None:
+                    self.votes = VoteTally()
+                self.votes.vote(player, target)
+            if action[0] == Actions.Kill:
+                if self.mafia_votes is None:
+                    self.mafia_votes = VoteTally()
+                self.mafia_votes.vote(player, target)
+            if action[0] == Actions.Check:
+                if self.policeman_votes is None:
+                    self.policeman_votes = VoteTally()
+                self.policeman_votes.vote(player, target)
+            
+            self.wait_for(name)
+
+    def leader(self, tally):
+        return tally.leader() if tally is not None else None
 
     def setup_day(self):
         if not self.lock.locked:
             raise ExpectedLockException
 
         if self.day != 0:
-            killed = GameState.evaluate_vote(self.mafia_votes)
+            killed = self.leader(self.mafia_votes)
             if killed is not None:
-                self.notifications.append((Notification.Voted, "Player " + killed + " was killed by the mafia"))
-                self.players[killed].alive = False
+                self.notify(Notification.Voted, Message.Killed, self.names[killed])
+                self.kill(killed)
                 self.alive_num -= 1
             else:
-                self.notifications.append((Notification.Voted, "No one was killed by the mafia this night"))
+                self.notify(Notification.Voted, Message.NoKill)
 
-            police_check = GameState.evaluate_vote(self.policeman_votes)
+            police_check = self.leader(self.policeman_votes)
             if police_check is not None:
-                self.notifications.append((Notification.Voted, "The player checked by the police is a " + self.players[police_check].role.name))
+                self.notify(Notification.Voted, Message.Checked, Role(self.roles[police_check]).name)
             else:
-                self.notifications.append((Notification.Voted, "The police failed to coordinate this night"))
+                self.notify(Notification.Voted, Message.NoCheck)
 
         if self.check_over():
             return True
 
         self.state = States.Day
-        self.done = set()
+        self.done = 0
         self.day += 1
-        self.votes = dict()
+        self.votes = self.mafia_votes = self.policeman_votes = None
 
         self.done_num = 0
 
-        self.notifications.append((Notification.ChangeState, "Good morning! A new day is starting."))
+        self.notify(Notification.ChangeState, Message.Morning)
 
-        for person, state in self.players.items():
-            if state.alive:
-                self.await_actions.append(person)
+        for player in members(self.alive):
+            self.wait_for(self.names[player])
     
-    def evaluate_vote(votedict):
-        # Independent expertise in who won the vote (for any type of voting)
-        # Hoping this function will be used for the next elections in Russia
-        votes_dict = dict()
-        maxvotes = 0
-        who = None
-        for vote in votedict.values():
-            if vote not in votes_dict:
-                votes_dict[vote] = 0
-            votes_dict[vote] += 1
-            if votes_dict[vote] == maxvotes:
-                who = None
-            if votes_dict[vote] > maxvotes:
-                who = vote
-                maxvotes = votes_dict[vote]
-        return who
+    # Who would be voted out (at day) or killed (at night) if the voting ended now
+    def current_leader(self):
+        with self.lock:
+            if not self.game_started:
+                return None
+            leader = self.leader(self.votes if self.state == States.Day else self.mafia_votes)
+            return self.names[leader] if leader is not None else None
 
-    
     def setup_night(self):
         if not self.lock.locked:
             raise ExpectedLockException
 
-        voted_out = GameState.evaluate_vote(self.votes)
+        voted_out = self.leader(self.votes)
         if voted_out is not None:
-            self.players[voted_out].alive = False
-            self.notifications.append((Notification.Voted, "Player " + voted_out + " was voted out"))
+            self.kill(voted_out)
+            self.notify(Notification.Voted, Message.VotedOut, self.names[voted_out])
             self.alive_num -= 1
         else:
-            self.notifications.append((Notification.Voted, "No one was voted out"))
+            self.notify(Notification.Voted, Message.NoVoteOut)
 
         if self.check_over():
             return True
 
-        self.done = set()
+        self.done = 0
         self.done_num = 0
-        self.mafia_votes = dict()
-        self.policeman_votes = dict()
+        self.votes = self.mafia_votes = self.policeman_votes = None
         self.state = States.Night
-        self.notifications.append((Notification.ChangeState, "The day is over, night is starting."))
+        self.notify(Notification.ChangeState, Message.Night)
 
-        for person, state in self.players.items():
-            if state.alive:
-                self.await_actions.append(person)
+        for player in members(self.alive):
+            self.wait_for(self.names[player])
     
     def check_over(self):
         if not self.lock.locked:
             raise ExpectedLockException
-        mafia_alive = 0
-        for person, state in self.players.items():
-            if state.alive and state.role == Role.Mafia:
-                mafia_alive += 1
-        
+        mafia_alive = self.alive_by_role[Role.Mafia.value]
+
         if mafia_alive == 0:
-            self.notifications.append((Notification.GameOver, "Civilians win!"))
+            self.notify(Notification.GameOver, Message.CiviliansWin)
             self.mafia_won = False
             return True
         if mafia_alive != 0 and mafia_alive * 2 >= self.alive_num:
-            self.notifications.append((Notification.GameOver, "Mafia wins!"))
+            self.notify(Notification.GameOver, Message.MafiaWins)
             self.mafia_won = True
             return True
         return False
     
     def take_notification(self):
+        # The text is only formatted here, when the notification is about to be sent
         with self.lock:
             if self.notifications:
-                return self.notifications.popleft()
+                notification, message, argument = self.notifications.pop(0)
+                return (notification, message.value.format(argument) if argument is not None else message.value)
     
     def take_await_actions(self):
         with self.lock:
             if self.await_actions:
                 return self.await_actions.pop()
+
+    def player_roles(self):
+        # name -> Role of everyone in the game, None before the start
+        with self.lock:
+            if not self.game_started:
+                return None
+            return {self.names[player]: Role(self.roles[player]) for player in members(self.present)}
+
+    def snapshot(self):
+        # The state as plain data for journal.py, without the notifications and prompts nobody has taken yet
+        with self.lock:
+            return {"names": list(self.names), "present": self.present, "roles": list(self.roles) if self.roles is not None else None,
+                    "alive": self.alive, "mafia": self.mafia, "policemen": self.policemen, "done": self.done,
+                    "started": self.game_started, "day": self.day, "state": self.state.value if self.state is not None else None,
+                    "tallies": [list(tally.votes.items()) if tally is not None else None for tally in (self.votes, self.mafia_votes, self.policeman_votes)],
+                    "alive_num": self.alive_num, "alive_by_role": list(self.alive_by_role) if self.alive_by_role is not None else None, "done_num": self.done_num,
+                    "mafia_won": self.mafia_won, "start_time": self.start_time}
+
+    def restore(state):
+        # A game from GameState.snapshot()
+        game = GameState()
+        game.names = list(state["names"])
+        game.index = {name: player for player, name in enumerate(game.names) if name is not None}
+        game.present = state["present"]
+        game.roles = bytearray(state["roles"]) if state["roles"] is not None else None
+        game.alive = state["alive"]
+        game.mafia = state["mafia"]
+        game.policemen = state["policemen"]
+        game.done = state["done"]
+        game.game_started = state["started"]
+        game.day = state["day"]
+        game.state = States(state["state"]) if state["state"] is not None else None
+        tallies = []
+        for votes in state["tallies"]:
+            tally = None
+            if votes is not None:
+                tally = VoteTally()
+                for voter, target in votes:
+                    tally.vote(voter, target)
+            tallies.append(tally)
+        game.votes, game.mafia_votes, game.policeman_votes = tallies
+        game.alive_num = state["alive_num"]
+        game.alive_by_role = list(state["alive_by_role"]) if state["alive_by_role"] is not None else None
+        game.done_num = state["done_num"]
+        game.mafia_won = state["mafia_won"]
+        game.start_time = state["start_time"]
+        return game
+
+    def forget_events(self):
+        # Drops the queued notifications and prompts, for a copy of the game that nobody serves
+        with self.lock:
+            self.notifications = self.await_actions = None
+
+    def results(self):
+        # (name, whether the player won) for everyone who stayed until the end of the game
+        with self.lock:
+            return [(self.names[player], self.mafia_won == bool(self.mafia >> player & 1)) for player in members(self.present)]
     
     def process_message(self, name):
         with self.lock:
             if not self.game_started:
-                return ([player.name for player in self.players.values()], "(pre-game chat)")
-            if not self.players[name].alive:
+                return ([self.names[player] for player in members(self.present)], "(pre-game chat)")
+            player = self.index.get(name)
+            if player is None:
+                return ([], "You are not in this game")
+            if not self.alive >> player & 1:
                 return ([], "Dead people cannot send messages")
             if self.state == States.Night:
-                if self.players[name].role == Role.Mafia:
-                    return ([player.name for player in self.players.values() if player.role == Role.Mafia], "(in mafia chat)")
+                if self.mafia >> player & 1:
+                    return ([self.names[player] for player in members(self.present & self.mafia)], "(in mafia chat)")
                 else:
                     return ([], "Only mafia can message at night")
             else:
-                return ([player.name for player in self.players.values()], "(main chat)")
\ No newline at end of file
+                return ([self.names[player] for player in members(self.present)], "(main chat)")
@@ -0,0 +1,86 @@
+import os
+
+import metrics
+from config import roles_config
+from mafia import MAX_PLAYERS
+
+# Matchmaking: which waiting players go to which game sessions, and when a session starts. On every dispatch the
+# whole queue of idle players is packed at once, oldest first. They go to the sessions that are still forming
+# (the ones too small to start first, then the oldest) as long as that places no fewer players, and the rest make
+# new sessions of the sizes in roles_config: as many players as possible in as few sessions as possible (13 players
+# are 5 + 4 + 4 rather than 6 + 6 and one waiting). Whoever is left waits for the next players.
+# A session starts as soon as it is full, or when its own timer runs out MATCH_WAIT seconds after it was made,
+# if it has enough players by then
+
+MATCH_WAIT = float(os.environ.get("MATCH_WAIT", 3))
+SIZES = sorted(roles_config)
+
+QUEUE_WAIT = metrics.Histogram("mafia_queue_wait_seconds", "Time a player waited in the queue for a game session")
+START_WAIT = metrics.Histogram("mafia_start_wait_seconds", "Time from entering the queue until the player's game started")
+
+
+def packing(count):
+    # For every number of players up to count: how many of them the best packing places, and the size of one of
+    # its sessions (0 if one player is left out)
+    placed = [0] * (count + 1)
+    sessions = [0] * (count + 1)
+    choice = [0] * (count + 1)
+    for total in range(1, count + 1):
+        placed[total], sessions[total] = placed[total - 1], sessions[total - 1]
+        for size in SIZES:
+            if size <= total and (placed[total - size] + size, -sessions[total - size] - 1) > (placed[total], -sessions[total]):
+                placed[total], sessions[total], choice[total] = placed[total - size] + size, sessions[total - size] + 1, size
+    return placed, choice
+
+
+def split(count, choice):
+    # Sizes of the new sessions for count players, the biggest first
+    sizes = []
+    while count:
+        if choice[count]:
+            sizes.append(choice[count])
+            count -= choice[count]
+        else:
+            count -= 1
+    return sorted(sizes, reverse=True)
+
+
+class Matchmaker:
+    def __init__(self, wait=MATCH_WAIT):
+        self.wait = wait
+        self.deadlines = dict() # game_id -> time.monotonic() when a session that has not started starts if it can
+        self.entered = dict() # address -> when a player placed in a session that has not started entered the queue
+
+    def plan(self, waiting, forming):
+        # waiting is the number of players in the queue, forming the (game_id, players) of the sessions that can
+        # take more, in the order they get them. Returns how many players each of those gets, [(game_id, count)],
+        # and the sizes of the new sessions
+        placed, choice = packing(waiting)
+        top_ups = []
+        for game_id, players in forming:
+            best = 0
+            for count in range(1, min(MAX_PLAYERS - players, waiting) + 1):
+                if count + placed[waiting - count] >= best + placed[waiting - best]:
+                    best = count
+            if best:
+                top_ups.append((game_id, best))
+                waiting -= best
+        return top_ups, split(waiting, choice)
+
+    def placed(self, address, entered, now):
+        QUEUE_WAIT.observe(now - entered)
+        self.entered[address] = entered
+
+    def started(self, game_id, addresses, now):
+        self.deadlines.pop(game_id, None)
+        for address in addresses:
+            entered = self.entered.pop(address, None)
+            if entered is not None:
+                START_WAIT.observe(now - entered)
+
+    def left(self, address):
+        self.entered.pop(address, None)
+
+    def finished(self, game_id):
+        # The session ended before it started
+        self.deadlines.pop(game_id, None)
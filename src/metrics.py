@@ -0,0 +1,190 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import threading
+import time
+
+# Counters, gauges and histograms of the game server, served in the Prometheus text format on
+# http://<host>:METRICS_PORT/metrics. Counters are always counted (one locked add). Timings are sampled:
+# with METRICS_SAMPLE=0.01 one timed operation in a hundred is measured, with 0 none are, so the timers
+# cost almost nothing when nobody looks at them. Histogram counts are counts of the measured operations
+
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_SAMPLE = float(os.environ.get("METRICS_SAMPLE", 1 if METRICS_PORT else 0))
+SAMPLE_EVERY = round(1 / METRICS_SAMPLE) if METRICS_SAMPLE > 0 else 0
+
+SECONDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120)
+SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+logger = logging.getLogger("METRICS")
+
+registry = dict() # (name, labels) -> metric, in registration order
+
+
+def label_text(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(sorted(labels.items()))
+        registry[(name, self.labels)] = self # A newer metric with the same name and labels replaces the old one
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, **labels):
+        Metric.__init__(self, name, help, labels)
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name + label_text(self.labels), self.value)]
+
+
+class Gauge(Metric):
+    # The value is read from function when the metrics are scraped, so the hot path does nothing
+    kind = "gauge"
+
+    def __init__(self, name, help, function, **labels):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def samples(self):
+        return [(self.name + label_text(self.labels), self.function())]
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exception):
+        pass
+
+
+NO_TIMER = NoTimer()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=SECONDS, **labels):
+        Metric.__init__(self, name, help, labels)
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.sum = 0
+        self.calls = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def sampled(self):
+        # Whether this call should be measured, one in SAMPLE_EVERY calls is
+        if not SAMPLE_EVERY:
+            return False
+        self.calls += 1 # A lost update only moves the sample
+        return self.calls % SAMPLE_EVERY == 0
+
+    def time(self):
+        # with histogram.time(): ... measures the block if the call is sampled
+        return Timer(self) if self.sampled() else NO_TIMER
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        result = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            result.append((self.name + "_bucket" + label_text(self.labels + (("le", bound),)), cumulative))
+        result.append((self.name + "_sum" + label_text(self.labels), total))
+        result.append((self.name + "_count" + label_text(self.labels), cumulative))
+        return result
+
+
+class TimedLock:
+    # A lock that records how long sampled acquisitions waited for it
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+
+    def __enter__(self):
+        if self.histogram.sampled():
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.histogram.observe(time.perf_counter() - start)
+        else:
+            self.lock.acquire()
+
+    def __exit__(self, *exception):
+        self.lock.release()
+
+
+def render():
+    lines = []
+    described = set()
+    for metric in list(registry.values()):
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+        try:
+            lines += [f"{name} {value}" for name, value in metric.samples()]
+        except Exception:
+            logger.exception("Failed to read %s", metric.name)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    # Starts the endpoint in the background if METRICS_PORT is set
+    if not METRICS_PORT:
+        return
+    server = ThreadingHTTPServer(("0.0.0.0", int(METRICS_PORT)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    logger.info("Serving metrics at port %s", METRICS_PORT)
@@ -0,0 +1,209 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os, sys
+
+sys.path.append("../protos")
+
+import grpc
+
+import server_pb2_grpc, messages_pb2
+
+import logs
+import metrics
+
+# A thin router in front of several game servers (nodes). It serves the same Server service as a node, so clients
+# connect to it as to a single server. On Register the router picks a node for the client, by consistent hashing
+# of the client address (ROUTER_POLICY=hash) or the node with the fewest users (ROUTER_POLICY=load). Everything
+# else the client sends goes to that node, so the client, its game and its Events stream all stay on one node.
+# A node that is down or draining refuses the registration and the next node is tried. The load of a node is the
+# number of users it reported in its last Status (the router does not see the ones it drops on its own) plus the
+# registrations routed to it since.
+# Chat does not go through the router: every node has its own queue on the shared broker (NODE_NAME), and tells
+# its clients the name in RegisterResult.chat_queue.
+#
+# Draining: python router.py drain <node> asks the router to send no one to the node any more, the node takes
+# no new players and lets its users go between games (they register again and get another node). It waits
+# until the node has no games and users left, then the node can be stopped. The router does not send anyone to
+# a drained node until it is restarted
+
+ROUTER_NODES = os.environ.get("ROUTER_NODES", "") # Addresses of the nodes, separated by commas
+ROUTER_POLICY = os.environ.get("ROUTER_POLICY", "hash")
+VIRTUAL_NODES = 256 # Points of every node on the hash ring
+DRAIN_POLL = 1
+STATUS_POLL = 1 # Seconds between Status calls to every node
+
+logger = logging.getLogger("ROUTER")
+
+
+def ring_hash(key):
+    # The same in every process, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes):
+        points = sorted((ring_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(VIRTUAL_NODES))
+        self.hashes = [point for point, node in points]
+        self.nodes = [node for point, node in points]
+        self.count = len(set(nodes))
+
+    def lookup(self, key):
+        # All the nodes in the order of the ring after the key, the first one owns the key
+        found = []
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        for index in range(len(self.nodes)):
+            node = self.nodes[(start + index) % len(self.nodes)]
+            if node not in found:
+                found.append(node)
+                if len(found) == self.count:
+                    break
+        return found
+
+
+class Node:
+    def __init__(self, address):
+        self.address = address
+        self.stub = server_pb2_grpc.ServerStub(grpc.aio.insecure_channel(address))
+        self.users = 0 # On the node at its last Status
+        self.registered = 0 # Routed to the node since then
+        self.draining = False
+        metrics.Gauge("mafia_router_clients", "Users on a node, by its last status and the registrations since", self.load, node=address)
+
+    def load(self):
+        return self.users + self.registered
+
+
+class Router(server_pb2_grpc.ServerServicer):
+    def __init__(self, addresses, policy):
+        self.nodes = {address: Node(address) for address in addresses}
+        self.ring = HashRing(addresses)
+        self.policy = policy
+        self.routes = dict() # client address -> Node
+
+    def candidates(self, address):
+        # Nodes to try for a registration, in order. A client that was on a node goes back to it first (it may
+        # have a game there that the node recovered after a restart)
+        if self.policy == "load":
+            nodes = sorted(self.nodes.values(), key=lambda node: node.load())
+        else:
+            nodes = [self.nodes[node] for node in self.ring.lookup(address)]
+        previous = self.routes.get(address)
+        if previous is not None:
+            nodes.remove(previous)
+            nodes.insert(0, previous)
+        return [node for node in nodes if not node.draining]
+
+    def route(self, address, node):
+        self.routes[address] = node
+        node.registered += 1
+
+    def node_of(self, address):
+        # A client the router does not know registered before the router restarted, most likely by the hash
+        node = self.routes.get(address)
+        return node if node is not None else self.nodes[self.ring.lookup(address)[0]]
+
+    async def forward(self, context, method, request):
+        try:
+            return await method(request)
+        except grpc.aio.AioRpcError as rpc_error:
+            await context.abort(rpc_error.code(), rpc_error.details())
+
+    async def Register(self, request, context):
+        for node in self.candidates(request.address):
+            try:
+                answer = await node.stub.Register(request)
+            except grpc.aio.AioRpcError as rpc_error:
+                logger.info("Node %s failed to register %s: %s", node.address, request.address, rpc_error.code())
+                continue
+            if answer.status == messages_pb2.RegisterResult.Status.Draining:
+                continue
+            if answer.status == messages_pb2.RegisterResult.Status.OK:
+                self.route(request.address, node)
+            return answer
+        await context.abort(grpc.StatusCode.UNAVAILABLE, "No node takes new players")
+
+    async def Leave(self, request, context):
+        node = self.node_of(request.address)
+        answer = await self.forward(context, node.stub.Leave, request)
+        if self.routes.get(request.address) is node:
+            self.routes.pop(request.address)
+        return answer
+
+    async def TakeAction(self, request, context):
+        return await self.forward(context, self.node_of(request.address).stub.TakeAction, request)
+
+    async def Ack(self, request, context):
+        return await self.forward(context, self.node_of(request.address).stub.Ack, request)
+
+    async def Events(self, request, context):
+        call = self.node_of(request.address).stub.Events(request)
+        try:
+            async for batch in call:
+                yield batch
+        except grpc.aio.AioRpcError as rpc_error:
+            # If the node is gone, the client registers again and gets another one
+            code = grpc.StatusCode.NOT_FOUND if rpc_error.code() == grpc.StatusCode.UNAVAILABLE else rpc_error.code()
+            await context.abort(code, rpc_error.details())
+        finally:
+            call.cancel() # When the client has gone
+
+    async def Drain(self, request, context):
+        node = self.nodes.get(request.node)
+        if node is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "Unknown node " + request.node)
+        if not node.draining:
+            logger.info("Draining node %s", node.address)
+            node.draining = True
+        return await self.forward(context, node.stub.Drain, request)
+
+    async def poll(self):
+        request = messages_pb2.StatusMessage()
+        while True:
+            for node in self.nodes.values():
+                registered = node.registered
+                try:
+                    status = await node.stub.Status(request, timeout=STATUS_POLL)
+                except grpc.aio.AioRpcError:
+                    continue # Down, it refuses registrations anyway
+                node.users = status.users
+                node.registered -= registered # The ones routed during the call may not be counted by the node yet
+            await asyncio.sleep(STATUS_POLL)
+
+
+async def run(address, nodes, policy):
+    router = Router(nodes, policy)
+    metrics.serve()
+
+    server = grpc.aio.server()
+    server_pb2_grpc.add_ServerServicer_to_server(router, server)
+    server.add_insecure_port(address)
+    await server.start()
+    logger.info("Started router at address %s for nodes %s (%s)", address, ", ".join(nodes), policy)
+    await asyncio.gather(router.poll(), server.wait_for_termination())
+
+
+async def drain(router_address, node):
+    stub = server_pb2_grpc.ServerStub(grpc.aio.insecure_channel(router_address))
+    request = messages_pb2.DrainMessage()
+    request.node = node
+    while True:
+        result = await stub.Drain(request)
+        print(f"{node}: {result.games} games, {result.users} users left", flush=True)
+        if not result.games and not result.users:
+            return
+        await asyncio.sleep(DRAIN_POLL)
+
+
+if __name__ == '__main__':
+    logs.setup()
+    address = "0.0.0.0:" + os.environ.get("ROUTER_PORT", "51074")
+    if len(sys.argv) > 2 and sys.argv[1] == "drain":
+        asyncio.run(drain(os.environ.get("ROUTER_ADDRESS", "127.0.0.1:" + os.environ.get("ROUTER_PORT", "51074")), sys.argv[2]))
+        sys.exit(0)
+    nodes = [node.strip() for node in ROUTER_NODES.split(",") if node.strip()]
+    if not nodes:
+        print("Set ROUTER_NODES to the addresses of the game servers")
+        sys.exit(1)
+    asyncio.run(run(address, nodes, ROUTER_POLICY))
@@ -0,0 +1,64 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler:
+    # Runs the server's dispatch function whenever something happens (wake) and runs timed jobs from a heap,
+    # so that the main loop never sleeps while there is work to do
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.timers = [] # Heap of (when, seq, period, callback)
+        self.counter = itertools.count()
+        self.woken = False
+        self.running = True
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify()
+
+    def call_later(self, delay, callback, period=None):
+        with self.condition:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.counter), period, callback))
+            self.condition.notify()
+
+    def call_every(self, period, callback, delay=None):
+        self.call_later(period if delay is None else delay, callback, period)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def take_due(self):
+        # Returns the callbacks whose time has come, rescheduling the periodic ones (condition must be held)
+        now = time.monotonic()
+        due = []
+        while self.timers and self.timers[0][0] <= now:
+            when, _, period, callback = heapq.heappop(self.timers)
+            due.append(callback)
+            if period is not None:
+                heapq.heappush(self.timers, (max(when + period, now), next(self.counter), period, callback))
+        return due
+
+    def run(self, dispatch):
+        while True:
+            with self.condition:
+                while self.running and not self.woken:
+                    if self.timers and self.timers[0][0] <= time.monotonic():
+                        break
+                    timeout = self.timers[0][0] - time.monotonic() if self.timers else None
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+                woken = self.woken
+                self.woken = False
+                due = self.take_due()
+
+            # Timed jobs that produce work for the dispatcher call wake() themselves
+            for callback in due:
+                callback()
+            if woken:
+                dispatch()
@@ -0,0 +1,523 @@
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+import messages_pb2
+
+import metrics
+from mafia import GameState, Notification, Actions
+from heartbeat import Heartbeat
+from stats import StatsReporter
+from journal import Journal, JOURNAL_DIR
+from chat import server_queue
+from matchmaking import Matchmaker
+
+PING_INTERVAL = float(os.environ.get("PING_INTERVAL", 1))
+PING_MISSES = int(os.environ.get("PING_MISSES", 2))
+PING_TIMEOUT = float(os.environ.get("PING_TIMEOUT", 1)) # The client answers after handling the batch the ping came with
+PING_SLICES = 10 # Heartbeat ticks per ping interval
+SLOW_RTT = float(os.environ.get("SLOW_RTT", 0.1))
+RECOVERY_TIMEOUT = float(os.environ.get("RECOVERY_TIMEOUT", 30)) # Seconds the players of recovered games have to come back
+NODE_NAME = os.environ.get("NODE_NAME") # Of this server in a cluster behind router.py
+
+session_logger = logging.getLogger("SERVER.session")
+action_logger = logging.getLogger("SERVER.action")
+notification_logger = logging.getLogger("SERVER.notification")
+chat_logger = logging.getLogger("SERVER.chat")
+
+REGISTRY_LOCK_WAIT = metrics.Histogram("mafia_registry_lock_wait_seconds", "Time spent waiting for the registry lock")
+REMOVE_USERS_SECONDS = metrics.Histogram("mafia_dispatch_seconds", "Time per dispatch step", step="remove_users")
+SEND_STUFF_SECONDS = metrics.Histogram("mafia_dispatch_seconds", "Time per dispatch step", step="send_stuff")
+PICK_GAMES_SECONDS = metrics.Histogram("mafia_dispatch_seconds", "Time per dispatch step", step="pick_games")
+ACTION_SECONDS = metrics.Histogram("mafia_take_action_seconds", "Time to handle a TakeAction call")
+ACTIONS_OK = metrics.Counter("mafia_actions_total", "Actions received", status="ok")
+ACTIONS_NOT_ALLOWED = metrics.Counter("mafia_actions_total", "Actions received", status="not_allowed")
+NOTIFICATIONS = metrics.Counter("mafia_notifications_total", "Game notifications sent to whole games")
+CHAT_MESSAGES = metrics.Counter("mafia_chat_messages_total", "Chat messages received from clients")
+PHASE_SECONDS = metrics.Histogram("mafia_phase_seconds", "Duration of game phases (days and nights)")
+GAMES_FINISHED = metrics.Counter("mafia_games_finished_total", "Games that ended")
+
+
+def random_email(name):
+    return name + "@" + random.choice(["gmail.com", "yandex.ru", "edu.hse.ru", "myself.com", "musician.org", "workmail.com"])
+
+
+class Sessions:
+    # Users, game sessions and the games themselves, the same for both server modes (server.py and aio_server.py).
+    # A mode only provides the transport: make_client, publish, wake and call_later, and serves the Events streams.
+    #
+    # Locking: registry_lock guards the user and game indexes (connected_users, user_by_name, unused_names,
+    # idle_users, games, members, open_games, game_locks). Each game has its own lock that serializes its
+    # dispatch and guards its members set. The registry lock may be held while taking a game lock, never
+    # the other way around. No network calls are made while holding either of them.
+    # In the asyncio mode everything runs on the event loop thread, so the locks are never contended
+    def __init__(self, db_server):
+        self.remove_queue = []
+        self.remove_queue_lock = threading.Lock()
+        self.registry_lock = metrics.TimedLock(REGISTRY_LOCK_WAIT)
+        self.heartbeat = Heartbeat(PING_INTERVAL, PING_MISSES, PING_TIMEOUT, self.leave, SLOW_RTT)
+
+        self.games = dict()
+        self.game_locks = dict()
+        self.unique_game_id = 0
+        self.members = dict() # game_id -> dict of address -> client of the players in the game session
+        self.open_games = dict() # Ids of the games that can still take players, in creation order (values unused)
+        self.idle_users = dict() # Address -> time.monotonic() of the users not in any game session, in arrival order
+        self.matchmaker = Matchmaker()
+
+        self.unused_names = {"IronGolem1543", "EpicWinner", "DoctorWho666", "grpc_master", "CreativeName1234", "LordVoldemort", "Placeholder133", "ConcurrencyRules", "IAmDoneWithThisHomework", "SpaceBar"}
+        self.unique_name_id = 0
+        self.connected_users = dict()
+        self.user_by_name = dict()
+        self.journal = Journal(JOURNAL_DIR) if JOURNAL_DIR else None
+        self.stats = StatsReporter(db_server, self.on_stats_sent if self.journal else None) if db_server else None
+        self.recovered = dict() # name -> game_id of the players of recovered games that have not registered again
+        self.recovery_deadline = None
+        self.chat_queue = server_queue(NODE_NAME)
+        self.draining = False
+        self.phase_started = dict() # game_id -> time.monotonic() of the start of the current phase
+
+        metrics.Gauge("mafia_connected_users", "Registered users", lambda: len(self.connected_users))
+        metrics.Gauge("mafia_idle_users", "Users waiting for a game session", lambda: len(self.idle_users))
+        metrics.Gauge("mafia_games", "Game sessions, started or not", lambda: len(self.games))
+        metrics.Gauge("mafia_open_games", "Game sessions that can still take players", lambda: len(self.open_games))
+        metrics.Gauge("mafia_remove_queue_depth", "Users waiting to be removed", lambda: len(self.remove_queue))
+
+    def make_client(self, address, name):
+        # The events.ClientEvents of a new user
+        raise NotImplementedError
+
+    def send(self, user, method, *args):
+        # Queues an event for the user's Events stream, method is one of the user's methods
+        method(*args)
+
+    def publish(self, addresses, text):
+        # Sends a chat message to every address
+        raise NotImplementedError
+
+    def wake(self):
+        # Makes the server run dispatch soon
+        raise NotImplementedError
+
+    def call_later(self, delay, callback):
+        # Runs callback on the dispatch thread after delay seconds
+        raise NotImplementedError
+
+    def new_game(self, game_id, state=None):
+        # The object that holds the state of a game, a new one or one restored from a GameState.snapshot()
+        game = GameState.restore(state) if state is not None else GameState()
+        if self.journal is not None:
+            game.journal = self.journal.recorder(game_id)
+        return game
+
+    def register(self, request):
+        answer = messages_pb2.RegisterResult()
+
+        with self.registry_lock:
+            if request.address in self.connected_users:
+                answer.status = messages_pb2.RegisterResult.Status.AlreadyRegistered
+                return answer
+            if self.draining:
+                answer.status = messages_pb2.RegisterResult.Status.Draining
+                return answer
+
+            name = None
+            if request.HasField("name"):
+                if request.name not in self.user_by_name:
+                    name = request.name
+            if name is None and self.unused_names:
+                name = random.choice(list(self.unused_names))
+            # The pool of names is used up, or the name belongs to a player of a recovered game
+            while name is None or name in self.user_by_name or (name in self.recovered and name != request.name):
+                self.unique_name_id += 1
+                name = "Player" + str(self.unique_name_id)
+
+            answer.status = messages_pb2.RegisterResult.Status.OK
+            answer.name = name
+            answer.users.extend(list(self.user_by_name.keys()))
+            answer.chat_queue = self.chat_queue
+
+            self.unused_names.discard(name)
+            user = self.make_client(request.address, name)
+            self.user_by_name[name] = user
+            self.connected_users[request.address] = user
+            self.heartbeat.add(request.address, user.Ping)
+
+            # A player of a recovered game gets back into it
+            game_id = self.recovered.pop(name, None)
+            others = None
+            if game_id in self.games:
+                user.game_id = game_id
+                game = self.games[game_id]
+                with self.game_locks[game_id]:
+                    others = list(self.members[game_id].values())
+                    self.members[game_id][user.address] = user
+            else:
+                self.idle_users[request.address] = time.monotonic()
+
+        if others is not None:
+            session_logger.info("%s is back in game %s", name, game_id)
+            self.send(user, user.new_game, [other.name for other in others], game_id)
+            for other in others:
+                self.send(other, other.NotifyNewPerson, name)
+            role = game.get_role(name)
+            if role is not None:
+                self.send(user, user.send_role, role)
+            options = game.actions(name)
+            if options:
+                self.send(user, user.give_options, options)
+
+        self.wake()
+        if self.stats:
+            self.stats.add_user(name, email=random_email(name), age=random.randint(0, 154))
+
+        return answer
+
+    def create_game(self):
+        # Must be called with the registry lock held
+        self.unique_game_id += 1
+        game_id = self.unique_game_id
+        self.games[game_id] = self.new_game(game_id)
+        self.game_locks[game_id] = threading.Lock()
+        self.members[game_id] = dict()
+        self.open_games[game_id] = None
+        self.wait_for_players(game_id, self.matchmaker.wait)
+        return game_id
+
+    def wait_for_players(self, game_id, delay):
+        # The session starts after delay if it is not full before, its timer wakes the dispatch then
+        self.matchmaker.deadlines[game_id] = time.monotonic() + delay
+        self.call_later(delay, self.wake)
+
+    def join_game(self, address, entered, game_id):
+        # Must be called with the registry lock held
+        user = self.connected_users[address]
+        if not self.games[game_id].add_player(user.name):
+            return False
+        if not self.games[game_id].is_open():
+            self.open_games.pop(game_id, None)
+
+        user.game_id = game_id
+        self.idle_users.pop(address)
+        self.matchmaker.placed(address, entered, time.monotonic())
+        with self.game_locks[game_id]:
+            others = list(self.members[game_id].values())
+            self.members[game_id][address] = user
+
+        session_logger.info("%s has joined game %s", user.name, game_id)
+
+        self.send(user, user.new_game, [other.name for other in others], game_id)
+        for other in others:
+            self.send(other, other.NotifyNewPerson, user.name)
+        return True
+
+    def leave(self, address):
+        # The user is removed by the next dispatch
+        with self.remove_queue_lock:
+            self.remove_queue.append(address)
+        self.wake()
+
+    def take_action(self, request):
+        address = request.address
+
+        answer = messages_pb2.ActionResult()
+
+        with self.registry_lock:
+            user = self.connected_users.get(address)
+            game = self.games.get(user.game_id) if user is not None and user.game_id is not None else None
+
+        if game is None:
+            answer.status = messages_pb2.ActionResult.Status.NotAllowed
+            return answer
+
+        actype = Actions(request.action.type)
+
+        name = user.name
+        action_logger.info("Received action %s %s from %s", actype, request.action.arg, name, extra={"game": user.game_id})
+        action = (actype, request.action.arg) if request.action.HasField("arg") else (actype,)
+
+        with ACTION_SECONDS.time():
+            allowed = game.try_action(name, action)
+        if allowed:
+            ACTIONS_OK.inc()
+            answer.status = messages_pb2.ActionResult.Status.OK
+            self.wake()
+        else:
+            ACTIONS_NOT_ALLOWED.inc()
+            answer.status = messages_pb2.ActionResult.Status.NotAllowed
+
+        return answer
+
+    def connected(self, address):
+        with self.registry_lock:
+            return self.connected_users.get(address)
+
+    def ack(self, request):
+        user = self.connected(request.address)
+        if user is not None:
+            user.ack(request.last_seq, request.ping)
+        return messages_pb2.AckResult()
+
+    def remove_users(self):
+        while True:
+            with self.remove_queue_lock:
+                if len(self.remove_queue) == 0:
+                    return
+                address = self.remove_queue.pop()
+
+            with self.registry_lock:
+                if address not in self.connected_users:
+                    continue
+                user = self.connected_users.pop(address)
+                self.heartbeat.remove(address)
+                self.user_by_name.pop(user.name)
+                self.unused_names.add(user.name)
+                self.idle_users.pop(address, None)
+                self.matchmaker.left(address)
+
+                others = []
+                if user.game_id is not None:
+                    self.games[user.game_id].remove_player(user.name)
+                    with self.game_locks[user.game_id]:
+                        self.members[user.game_id].pop(address, None)
+                        others = list(self.members[user.game_id].values())
+                    if self.games[user.game_id].is_open():
+                        self.open_games[user.game_id] = None
+
+            session_logger.info("Say goodbye to %s they left the server", user.name)
+            self.send(user, user.close) # Ends the user's Events stream
+            for other in others:
+                self.send(other, other.NotifyPersonLeave, user.name)
+
+    def send_game_notifications(self, game_id):
+        # Must be called with the game lock held
+        notification = self.games[game_id].take_notification()
+
+        if notification is None:
+            return False
+
+        notification_logger.info("Sending everyone in game %s %s", game_id, notification, extra={"game": game_id})
+        NOTIFICATIONS.inc()
+        if notification[0] in (Notification.GameStarts, Notification.ChangeState, Notification.GameOver):
+            now = time.monotonic()
+            started = self.phase_started.get(game_id)
+            if started is not None:
+                PHASE_SECONDS.observe(now - started)
+            self.phase_started[game_id] = now
+        for user in self.members[game_id].values():
+            self.send(user, user.game_notification, notification)
+
+        if notification[0] == Notification.GameStarts:
+            for user in self.members[game_id].values():
+                self.send(user, user.send_role, self.games[game_id].get_role(user.name))
+
+        if notification[0] == Notification.GameOver:
+            return None
+
+        return True
+
+    def send_actions(self, game_id):
+        # Must be called with the game lock held
+        game = self.games[game_id]
+        waiting_for = game.take_await_actions()
+        if waiting_for is None:
+            return False
+
+        for user in self.members[game_id].values():
+            if user.name == waiting_for:
+                self.send(user, user.give_options, game.actions(waiting_for))
+        return True
+
+    def serve_game(self, game_id):
+        # Sends everything the game has queued up, returns False if the game is over
+        with self.game_locks[game_id]:
+            while True:
+                sent = self.send_game_notifications(game_id)
+                if sent is None:
+                    return False
+                if not sent and not self.send_actions(game_id):
+                    return True
+
+    def finish_game(self, game_id):
+        with self.registry_lock:
+            game = self.games.pop(game_id)
+            self.open_games.pop(game_id, None)
+            self.matchmaker.finished(game_id)
+            self.phase_started.pop(game_id, None)
+            now = time.monotonic()
+            with self.game_locks.pop(game_id):
+                for address, user in self.members.pop(game_id).items():
+                    user.game_id = None
+                    self.idle_users[address] = now
+
+        GAMES_FINISHED.inc()
+        results = game.results()
+        ingame = round(time.time() - game.start_time, 3) if results else 0
+        if self.journal is not None:
+            # Before the results go to the stats reporter, which may report them sent right away
+            self.journal.append(game_id, "finish", results if self.stats else None, ingame)
+        if self.stats:
+            self.report(game_id, results, ingame)
+
+    def report(self, game_id, results, ingame):
+        self.stats.add_game(game_id, {name: dict(played=1, wins=int(won), ingame=ingame) for name, won in results})
+
+    def on_stats_sent(self, game_ids):
+        # Called from the stats reporter thread
+        self.journal.append(None, "reported", game_ids)
+
+    def recover(self):
+        # Brings back the games of the previous run from the journal. Their players get them back when they register
+        # again with the same name, the ones that do not come back within RECOVERY_TIMEOUT are removed from them
+        if self.journal is None:
+            return
+        games, unreported, last_game_id = self.journal.recover()
+        with self.registry_lock:
+            self.unique_game_id = max(self.unique_game_id, last_game_id)
+            for game_id, state in games.items():
+                self.games[game_id] = self.new_game(game_id, state)
+                self.game_locks[game_id] = threading.Lock()
+                self.members[game_id] = dict()
+                if self.games[game_id].is_open():
+                    self.open_games[game_id] = None
+                if not state["started"]:
+                    # Waits for its players to come back before it starts
+                    self.wait_for_players(game_id, RECOVERY_TIMEOUT)
+                for name in state["names"]:
+                    if name is not None:
+                        self.recovered[name] = game_id
+            self.unused_names -= set(self.recovered)
+            self.recovery_deadline = time.monotonic() + RECOVERY_TIMEOUT
+        if self.stats:
+            for game_id, (results, ingame) in unreported.items():
+                self.report(game_id, results, ingame)
+        session_logger.info("Recovered %s games with %s players", len(games), len(self.recovered))
+
+    def drop_unrecovered(self):
+        # The players of recovered games that have not come back in time leave them
+        if not self.recovered or time.monotonic() < self.recovery_deadline:
+            return
+        with self.registry_lock:
+            missing, self.recovered = self.recovered, dict()
+            for name, game_id in missing.items():
+                game = self.games.get(game_id)
+                if game is not None:
+                    game.remove_player(name)
+                    if game.is_open():
+                        self.open_games[game_id] = None
+            self.unused_names |= set(missing) - set(self.user_by_name)
+        session_logger.info("%s players of recovered games did not come back", len(missing))
+
+    def send_stuff(self):
+        with self.registry_lock:
+            game_ids = list(self.games.keys())
+
+        for game_id in game_ids:
+            if not self.serve_game(game_id):
+                self.finish_game(game_id)
+
+    def pick_games(self):
+        with self.registry_lock:
+            if self.draining:
+                # Users between games go, they register again at the router which sends them to another node
+                for address in self.idle_users:
+                    self.leave(address)
+                self.idle_users.clear()
+                return
+            if not self.idle_users:
+                return
+
+            # The sessions too small to start get players first, then the oldest ones
+            forming = sorted(self.open_games, key=lambda game_id: self.games[game_id].is_ok())
+            top_ups, sizes = self.matchmaker.plan(len(self.idle_users), [(game_id, self.games[game_id].player_count()) for game_id in forming])
+            waiting = iter(list(self.idle_users.items()))
+            for game_id, count in top_ups:
+                for address, entered in itertools.islice(waiting, count):
+                    self.join_game(address, entered, game_id)
+            for size in sizes:
+                game_id = self.create_game()
+                for address, entered in itertools.islice(waiting, size):
+                    self.join_game(address, entered, game_id)
+
+    def start_games(self):
+        # Starts the sessions that are full and the ones whose timer has run out, if they have enough players
+        empty = []
+        started = False
+        now = time.monotonic()
+        with self.registry_lock:
+            for game_id, deadline in list(self.matchmaker.deadlines.items()):
+                game = self.games[game_id]
+                if game.is_ok() and (now >= deadline or not game.is_open()):
+                    session_logger.info("Game %s is running...", game_id)
+                    game.start_game()
+                    self.open_games.pop(game_id, None)
+                    self.matchmaker.started(game_id, self.members[game_id], now)
+                    started = True
+                elif self.draining and not game.is_ok():
+                    # No one else is coming, the players of a game that cannot start go as well
+                    for address in self.members[game_id]:
+                        self.leave(address)
+                    if not self.members[game_id]:
+                        empty.append(game_id)
+        for game_id in empty:
+            self.finish_game(game_id)
+        if started:
+            self.wake() # The GameStarts notifications
+
+    def drain(self):
+        # Takes no new users and lets the current games end, returns how many games and users are left
+        if not self.draining:
+            session_logger.info("Draining, %s games are left", len(self.games))
+            self.draining = True
+            self.wake()
+        result = messages_pb2.DrainResult()
+        with self.registry_lock:
+            result.games = len(self.games)
+            result.users = len(self.connected_users)
+        return result
+
+    def status(self):
+        # How loaded the node is, for the router
+        result = messages_pb2.NodeStatus()
+        with self.registry_lock:
+            result.games = len(self.games)
+            result.users = len(self.connected_users)
+        result.draining = self.draining
+        return result
+
+    def dispatch(self):
+        # Called right after any event (registration, leave, action, timer)
+        self.drop_unrecovered()
+        with REMOVE_USERS_SECONDS.time():
+            self.remove_users()
+        with SEND_STUFF_SECONDS.time():
+            self.send_stuff()
+        with PICK_GAMES_SECONDS.time():
+            self.pick_games()
+        self.start_games()
+
+    def client_message(self, address, body):
+        CHAT_MESSAGES.inc()
+        text = body.decode(errors="replace")
+        with self.registry_lock:
+            player = self.connected_users.get(address)
+            if player is None:
+                return
+            game_id = player.game_id
+            game = self.games.get(game_id) if game_id is not None else None
+            game_lock = self.game_locks.get(game_id)
+        chat_logger.info("Got a message from %s: %s", player.name, text, extra={"game": game_id})
+
+        if game is None:
+            self.publish([player.address], "SERVER: Cannot send messages while not in game session")
+            return
+
+        recv, comment = game.process_message(player.name)
+        with game_lock:
+            recipients = [address for address, user in self.members.get(game_id, {}).items() if user.name in recv and user.name != player.name]
+        self.publish(recipients, f"{player.name}{comment}: {text}")
+        if not recv:
+            self.publish([player.address], f"SERVER: {comment}")
@@ -0,0 +1,355 @@
+import atexit
+from concurrent.futures import Future, TimeoutError
+from collections import deque
+import itertools
+import logging
+import multiprocessing
+import threading
+
+from config import roles_config, Role
+from mafia import GameState, Notification, MAX_PLAYERS
+
+# Sharded mode: the games live in worker processes (shards), the front process only keeps the players and
+# the clients. The front sends commands to a shard in batches without waiting, except for actions and chat
+# messages that need an answer. After every batch the shard drains the games it touched (notifications,
+# roles, awaited players with their options, results) and sends all of that back in one message, with the
+# journal records of the games if there is a journal
+
+logger = logging.getLogger("SERVER")
+
+LOST_MESSAGE = "The game was lost because of a server error"
+REQUEST_TIMEOUT = 5 # Seconds to wait for the answer of a shard before giving up as if it crashed
+
+
+class ShardCrashed(Exception):
+    pass
+
+
+def drain(game):
+    # Everything the game has for the clients: (notifications, roles, awaited, over)
+    notifications = []
+    roles = None
+    over = None
+    while True:
+        notification = game.take_notification()
+        if notification is None:
+            break
+        notifications.append(notification)
+        if notification[0] == Notification.GameStarts:
+            roles = game.player_roles()
+        if notification[0] == Notification.GameOver:
+            over = (game.results(), game.start_time)
+            break
+
+    awaited = []
+    while over is None:
+        name = game.take_await_actions()
+        if name is None:
+            break
+        awaited.append((name, game.actions(name)))
+    return notifications, roles, awaited, over
+
+
+def worker(connection, journaling):
+    # Runs in the shard process. Commands are (kind, game_id, ...), requests also carry a request id
+    games = dict()
+    records = [] # For the journal, sent with the next answer
+    while True:
+        try:
+            batch = connection.recv()
+            while connection.poll():
+                batch += connection.recv()
+        except (EOFError, OSError):
+            return # The front process has stopped
+
+        replies = []
+        touched = dict() # Ids of the games to drain, in order (values unused)
+        for command in batch:
+            kind, game_id = command[0], command[1]
+            if kind == "new":
+                games[game_id] = GameState.restore(command[2]) if command[2] is not None else GameState()
+                if journaling:
+                    games[game_id].journal = lambda *record, game_id=game_id: records.append((game_id,) + record)
+                continue
+            game = games.get(game_id)
+            if kind in ("action", "message", "options"):
+                request_id = command[2]
+                try:
+                    if game is None:
+                        replies.append((request_id, False, None))
+                    elif kind == "action":
+                        replies.append((request_id, True, game.try_action(command[3], command[4])))
+                    elif kind == "options":
+                        replies.append((request_id, True, game.actions(command[3])))
+                    else:
+                        replies.append((request_id, True, game.process_message(command[3])))
+                except Exception as error:
+                    replies.append((request_id, True, error))
+            elif game is None:
+                continue
+            elif kind == "add":
+                game.add_player(command[2])
+            elif kind == "remove":
+                game.remove_player(command[2])
+            elif kind == "start":
+                game.start_game()
+            touched[game_id] = None
+
+        events = []
+        for game_id in touched:
+            game = games.get(game_id)
+            if game is None:
+                continue
+            notifications, roles, awaited, over = drain(game)
+            if over is not None:
+                games.pop(game_id)
+            if notifications or awaited:
+                events.append((game_id, notifications, roles, awaited, over))
+        try:
+            connection.send((replies, events, records))
+        except OSError:
+            return
+        records.clear()
+
+
+class ShardGame:
+    # The front side of a game owned by a shard, used by Sessions like a GameState. Joins, leaves and starts are
+    # decided from the local list of players and sent on without waiting. What the game has for the clients
+    # is received from the shard and kept here until Sessions.serve_game takes it. state is a GameState.snapshot()
+    # of a recovered game
+    def __init__(self, shard, game_id, state=None):
+        self.shard = shard
+        self.game_id = game_id
+        self.players = dict() # Ordered set of names
+        self.started = False
+        self.lost = False
+
+        self.notifications = deque()
+        self.awaited = deque() # (name, options)
+        self.options = dict() # name -> options of the last prompt taken
+        self.roles = dict()
+        self.over = None # (results, start_time)
+        self.start_time = None
+        if state is not None:
+            self.players = dict.fromkeys(name for name in state["names"] if name is not None)
+            self.started = state["started"]
+            if self.started:
+                self.roles = {name: Role(role) for name, role in zip(state["names"], state["roles"]) if name is not None}
+        shard.add_game(self, state)
+
+    def add_player(self, name):
+        if self.started or len(self.players) + 1 > MAX_PLAYERS:
+            return False
+        self.players[name] = None
+        self.command("add", name)
+        return True
+
+    def remove_player(self, name):
+        if name in self.players:
+            del self.players[name]
+            self.command("remove", name)
+
+    def player_count(self):
+        return len(self.players)
+
+    def is_ok(self):
+        return len(self.players) in roles_config
+
+    def is_open(self):
+        return not self.started and len(self.players) < MAX_PLAYERS
+
+    def start_game(self):
+        if not self.started:
+            self.started = True
+            self.command("start")
+
+    def try_action(self, name, action):
+        return self.request("action", False, name, action)
+
+    def process_message(self, name):
+        return self.request("message", ([], LOST_MESSAGE), name)
+
+    def command(self, kind, *args):
+        if not self.lost:
+            self.shard.command((kind, self.game_id) + args)
+
+    def request(self, kind, default, *args):
+        if self.lost:
+            return default
+        try:
+            found, result = self.shard.request(kind, self.game_id, *args)
+        except ShardCrashed:
+            return default
+        if not found:
+            return default
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def receive(self, notifications, roles, awaited, over):
+        if roles is not None:
+            self.roles = roles
+        self.notifications.extend(notifications)
+        self.awaited.extend(awaited)
+        if over is not None:
+            self.over = over
+            self.start_time = over[1]
+
+    def lose(self):
+        self.lost = True
+        self.awaited.clear()
+        self.notifications.append((Notification.GameOver, LOST_MESSAGE))
+        self.over = ([], None)
+
+    def take_notification(self):
+        if self.notifications:
+            return self.notifications.popleft()
+
+    def take_await_actions(self):
+        if self.awaited:
+            name, options = self.awaited.popleft()
+            self.options[name] = options
+            return name
+
+    def actions(self, name):
+        if name in self.options:
+            return self.options[name]
+        return self.request("options", [], name) # A player back in a recovered game, nothing was taken for them yet
+
+    def get_role(self, name):
+        return self.roles.get(name)
+
+    def results(self):
+        return self.over[0] if self.over is not None else []
+
+
+class Shard:
+    # One worker process. A writer thread sends the queued commands in batches, a reader thread receives the
+    # answers and the drained games and hands the games to on_events. If the worker dies, its games are lost
+    # (they end with a GameOver notification) and a new worker takes the next games
+    def __init__(self, number, context, on_events, on_journal):
+        self.number = number
+        self.context = context
+        self.on_events = on_events
+        self.on_journal = on_journal
+        self.lock = threading.Lock()
+        self.has_commands = threading.Condition(self.lock)
+        self.outbox = []
+        self.requests = dict() # request id -> Future
+        self.games = dict() # game_id -> ShardGame
+        self.request_ids = itertools.count()
+        self.stopping = False
+        self.spawn()
+        threading.Thread(target=self.write, daemon=True, name=f"shard-{number}-writer").start()
+        threading.Thread(target=self.read, daemon=True, name=f"shard-{number}-reader").start()
+
+    def spawn(self):
+        self.connection, child = self.context.Pipe()
+        self.process = self.context.Process(target=worker, args=(child, self.on_journal is not None), daemon=True, name=f"shard-{self.number}")
+        self.process.start()
+        child.close()
+
+    def add_game(self, game, state):
+        with self.lock:
+            self.games[game.game_id] = game
+            self.outbox.append(("new", game.game_id, state))
+            self.has_commands.notify()
+
+    def command(self, command):
+        with self.lock:
+            self.outbox.append(command)
+            self.has_commands.notify()
+
+    def request(self, kind, game_id, *args):
+        # Waits for the answer of the shard: (whether the game was there, result)
+        future = Future()
+        with self.lock:
+            request_id = next(self.request_ids)
+            self.requests[request_id] = future
+            self.outbox.append((kind, game_id, request_id) + args)
+            self.has_commands.notify()
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except TimeoutError:
+            # The shard hangs without exiting, the caller gets the same answer as for a crash
+            with self.lock:
+                self.requests.pop(request_id, None)
+            logger.info("Shard %s did not answer in %ss (request %s)", self.number, REQUEST_TIMEOUT, kind)
+            raise ShardCrashed()
+
+    def write(self):
+        while True:
+            with self.lock:
+                while not self.outbox:
+                    self.has_commands.wait()
+                batch, self.outbox = self.outbox, []
+                connection = self.connection
+            try:
+                connection.send(batch)
+            except (OSError, ValueError):
+                pass # The reader notices the crash
+
+    def read(self):
+        while True:
+            connection = self.connection
+            try:
+                replies, events, records = connection.recv()
+            except (EOFError, OSError):
+                if self.stopping:
+                    return # The server is exiting and the shard went down with it
+                self.crashed(connection)
+                continue
+            if records:
+                self.on_journal(records) # Before a finished game is handed over
+
+            with self.lock:
+                # A request that timed out is not waited for any more
+                futures = [(self.requests.pop(request_id), found, result) for request_id, found, result in replies if request_id in self.requests]
+                served = []
+                for game_id, notifications, roles, awaited, over in events:
+                    game = self.games.get(game_id)
+                    if game is None:
+                        continue
+                    game.receive(notifications, roles, awaited, over)
+                    served.append(game_id)
+                    if over is not None:
+                        self.games.pop(game_id)
+            for future, found, result in futures:
+                future.set_result((found, result))
+            if served:
+                self.on_events(served)
+
+    def crashed(self, connection):
+        with self.lock:
+            connection.close()
+            self.process.join(1)
+            logger.info("Shard %s crashed (exit code %s), restarting it", self.number, self.process.exitcode)
+            lost, self.games = list(self.games.values()), dict()
+            requests, self.requests = list(self.requests.values()), dict()
+            self.outbox = []
+            self.spawn()
+
+        for future in requests:
+            future.set_exception(ShardCrashed())
+        for game in lost:
+            logger.info("Game %s was lost with shard %s", game.game_id, self.number)
+            game.lose()
+        if lost:
+            self.on_events([game.game_id for game in lost])
+
+
+class Shards:
+    # Routes every game to one of the worker processes by its id. on_events(game_ids) is called from the reader
+    # thread of a shard when those games have something for the clients, a game is always served by one thread.
+    # on_journal(records) gets the journal records of the games, if it is given
+    def __init__(self, number, on_events, on_journal=None):
+        context = multiprocessing.get_context("spawn") # Forking a process with grpc threads running is not safe
+        self.shards = [Shard(index, context, on_events, on_journal) for index in range(number)]
+        atexit.register(self.stop) # Runs before multiprocessing stops the shard processes
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stopping = True
+
+    def new_game(self, game_id, state=None):
+        return ShardGame(self.shards[game_id % len(self.shards)], game_id, state)
@@ -0,0 +1,115 @@
+import random
+import time
+
+from mafia import GameState, Notification
+
+
+def random_bot(rng, name, options):
+    # Same choice as Client.GiveActionOptions makes
+    return rng.choice(options)
+
+
+class SimulatedGame:
+    # One game driven in-process the way the server drives it: notifications are taken, everyone who is awaited
+    # is asked for an action and the bot's answer goes through try_action
+    def __init__(self, players, bot=random_bot, rng=random):
+        self.names = [f"Bot{index}" for index in range(players)]
+        self.bot = bot
+        self.rng = rng
+        self.game = GameState()
+        for name in self.names:
+            self.game.add_player(name)
+
+        self.over = False
+        self.actions = 0 # Actions the bots took
+        self.transitions = 0 # Days, nights and game overs that started
+        self.latencies = [] # Seconds between the action that ended a phase and its notifications being taken
+
+    def start(self):
+        self.game.start_game(self.rng.getrandbits(64)) # The roles come from the same generator as the bots' choices
+        self.take_notifications()
+
+    def take_notifications(self):
+        # Returns whether there were any
+        taken = False
+        while True:
+            notification = self.game.take_notification()
+            if notification is None:
+                return taken
+            taken = True
+            if notification[0] == Notification.ChangeState:
+                self.transitions += 1
+            if notification[0] == Notification.GameOver:
+                self.transitions += 1
+                self.over = True
+
+    def step(self):
+        # Lets one awaited player act, returns False once the game is over
+        if self.over:
+            return False
+        name = self.game.take_await_actions()
+        if name is None:
+            self.over = True
+            return False
+
+        options = self.game.actions(name)
+        if options:
+            action = self.bot(self.rng, name, options)
+            start = time.perf_counter()
+            if self.game.try_action(name, action):
+                self.actions += 1
+            if self.take_notifications():
+                self.latencies.append(time.perf_counter() - start)
+        return not self.over
+
+
+class SimulationResult:
+    def __init__(self, games, players, elapsed, actions, transitions, latencies):
+        self.games = games
+        self.players = players
+        self.elapsed = elapsed
+        self.actions = actions
+        self.transitions = transitions
+        self.latencies = sorted(latencies)
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        return self.latencies[min(len(self.latencies) - 1, int(fraction * len(self.latencies)))]
+
+    def games_per_second(self):
+        return self.games / self.elapsed
+
+    def transitions_per_second(self):
+        return self.transitions / self.elapsed
+
+
+def simulate(games, players, concurrent=100, bot=random_bot, seed=None):
+    # Plays `games` games of `players` bots, keeping up to `concurrent` of them in progress at once
+    # and letting them act in turns, like the server serves all of its games in one loop
+    rng = random.Random(seed) # Everything random in the run comes from it, so a seed repeats the run
+    actions = transitions = 0
+    latencies = []
+    started = 0
+    running = []
+
+    begin = time.perf_counter()
+    while started < games or running:
+        while started < games and len(running) < concurrent:
+            game = SimulatedGame(players, bot, rng)
+            game.start()
+            running.append(game)
+            started += 1
+
+        still_running = []
+        for game in running:
+            if game.step():
+                still_running.append(game)
+            else:
+                actions += game.actions
+                transitions += game.transitions
+                latencies += game.latencies
+        running = still_running
+    elapsed = time.perf_counter() - begin
+
+    return SimulationResult(games, players, elapsed, actions, transitions, latencies)
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+FLUSH_PERIOD = 1 # Seconds between batches
+MAX_BACKOFF = 30
+REQUEST_TIMEOUT = 5
+
+logger = logging.getLogger("STATS")
+
+
+class StatsReporter:
+    # Collects new profiles and game results in memory, merges them per user and sends them to
+    # the rest api server in batches from a background thread, so the game never waits for it.
+    # A batch that failed to arrive is merged back and retried later, one the server rejects is not.
+    # on_sent(game_ids) is told which games (see add_game) have had the results of all their players accepted
+    def __init__(self, db_server, on_sent=None):
+        self.db_server = db_server
+        self.on_sent = on_sent
+        self.lock = threading.Lock()
+        self.created = dict() # name -> profile fields
+        self.deltas = dict() # name -> {"played": ..., "wins": ..., "ingame": ...}
+        self.games = [] # (game_id, names of its players) of the games whose results are in deltas
+
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        threading.Thread(target=self.run, daemon=True, name="stats").start()
+
+    def add_user(self, name, **profile):
+        with self.lock:
+            self.created.setdefault(name, profile)
+
+    def add_result(self, name, **deltas):
+        with self.lock:
+            StatsReporter.merge(self.deltas, {name: deltas})
+
+    def add_game(self, game_id, deltas):
+        # The results of a game, name -> columns
+        with self.lock:
+            StatsReporter.merge(self.deltas, deltas)
+            self.games.append((game_id, list(deltas)))
+
+    def merge(into, deltas):
+        for name, columns in deltas.items():
+            current = into.setdefault(name, dict())
+            for column, value in columns.items():
+                current[column] = current.get(column, 0) + value
+
+    def take(self):
+        with self.lock:
+            created, deltas, games = self.created, self.deltas, self.games
+            self.created, self.deltas, self.games = dict(), dict(), []
+        return created, deltas, games
+
+    def give_back(self, created, deltas, games=()):
+        with self.lock:
+            for name, profile in created.items():
+                self.created.setdefault(name, profile)
+            StatsReporter.merge(self.deltas, deltas)
+            self.games.extend(games)
+
+    def send(self, created, deltas):
+        # Returns "sent", "retry" (connection problems or 5xx) or "rejected" (4xx, sending it again would not help)
+        try:
+            response = self.session.post(self.db_server + "/users/bulk", json={"create": created, "add": deltas}, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as error:
+            logger.info("Failed to report stats for %s users, will retry: %s", len(set(created) | set(deltas)), error)
+            return "retry"
+        if response.status_code >= 500:
+            logger.info("Failed to report stats for %s users, will retry: status %s", len(set(created) | set(deltas)), response.status_code)
+            return "retry"
+        if response.status_code >= 400:
+            return "rejected"
+        return "sent"
+
+    def flush(self):
+        created, deltas, games = self.take()
+        result = self.send(created, deltas) if created or deltas else "sent"
+        if result == "retry":
+            self.give_back(created, deltas, games)
+            return False
+        sent = [game_id for game_id, names in games]
+        if result == "rejected":
+            # Some row is bad: every user is sent alone, so that only the bad ones are dropped
+            names = set(created) | set(deltas)
+            if len(names) > 1:
+                results = {name: self.send_one(name, {name: created[name]} if name in created else dict(), {name: deltas[name]} if name in deltas else dict())
+                           for name in names}
+            else:
+                logger.info("Rest api server rejected the stats of %s, dropping them", next(iter(names)))
+                results = dict.fromkeys(names, "rejected")
+            # A game is sent once the rows of all its players are, one with a row to retry waits for it. One with a
+            # rejected row never is, its results stay in the journal
+            sent, retried = [], []
+            for game_id, players in games:
+                outcomes = {results[name] for name in players}
+                if outcomes <= {"sent"}:
+                    sent.append(game_id)
+                elif "rejected" not in outcomes:
+                    retried.append((game_id, players))
+            self.give_back(dict(), dict(), retried)
+        if sent and self.on_sent is not None:
+            self.on_sent(sent)
+        return True
+
+    def send_one(self, name, created, deltas):
+        result = self.send(created, deltas)
+        if result == "rejected":
+            logger.info("Rest api server rejected the stats of %s, dropping them", name)
+        if result == "retry":
+            self.give_back(created, deltas)
+        return result
+
+    def run(self):
+        delay = FLUSH_PERIOD
+        while True:
+            time.sleep(delay)
+            delay = FLUSH_PERIOD if self.flush() else min(delay * 2, MAX_BACKOFF)